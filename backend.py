@@ -0,0 +1,242 @@
+from typing import List, Optional
+from pathlib import Path
+from threading import Lock
+import asyncio
+import uuid
+from uuid import UUID
+
+from nicegui import run, Event
+from fastapi import Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from loguru import logger
+from sqlalchemy import select
+
+from db import session_factory
+from db import City as DbCity
+from db import FileManifest
+from models import CityModel
+from views import openseadragon_dir, openseadragon_url
+from catalog import Catalog
+from serving import add_routes
+from city_index import CityIndex
+from sampler import CitySampler
+from tag_index import TagIndex
+from similarity import SimilarityIndex
+from snapshot import Snapshot, read_meta, snapshot_dir
+from metrics import metrics, instrument_engine, in_context, SamplingProfiler, profiler_enabled
+
+# The website's shared state. It's made once per process, when this is first imported, and shared by every visitor.
+
+# One short lived session per request or handler, from a connection pool. See run_db().
+sessions = session_factory()
+instrument_engine(sessions.kw["bind"])
+cities_dir = Path("cities")
+city_images = Path("city_images")
+
+catalog = Catalog(sessions, city_images)
+# Built the first time something needs them, so they don't slow down startup.
+# The sampler and tag index share the one CityIndex.
+city_index: Optional[CityIndex] = None
+city_sampler: Optional[CitySampler] = None
+tag_index: Optional[TagIndex] = None
+similarity_index: Optional[SimilarityIndex] = None
+# These are built and updated from worker threads, this stops two handlers building the same thing at once.
+index_lock = Lock()
+# Fired (with no arguments) once the watcher's new cities are in the indexes, for the pages to update themselves.
+cities_added = Event()
+
+
+async def io_bound(fn, *args):
+    """run.io_bound(), but queries fn runs still count toward the UI interaction that called it."""
+    return await run.io_bound(in_context(fn), *args)
+
+
+async def run_db(fn, *args):
+    """
+    Runs fn(db_session, *args) in a worker thread with its own session, so a slow query doesn't hold up the
+    event loop, and with it every other connected user.
+    """
+    def work():
+        with sessions() as db_session:
+            return fn(db_session, *args)
+    return await io_bound(work)
+
+
+def get_city_index() -> CityIndex:
+    """Blocks while the index is built, call it from a worker thread."""
+    global city_index
+    with index_lock:
+        if city_index is None:
+            with sessions() as db_session:
+                city_index = CityIndex.build(db_session)
+        return city_index
+
+
+def get_sampler() -> CitySampler:
+    global city_sampler
+    index = get_city_index()
+    with index_lock:
+        if city_sampler is None:
+            city_sampler = CitySampler(index)
+        return city_sampler
+
+
+def get_tag_index() -> TagIndex:
+    global tag_index
+    index = get_city_index()
+    with index_lock:
+        if tag_index is None:
+            with sessions() as db_session:
+                tag_index = TagIndex.build(db_session, index)
+        return tag_index
+
+
+def get_similarity_index() -> SimilarityIndex:
+    global similarity_index
+    with index_lock:
+        if similarity_index is None:
+            with sessions() as db_session:
+                similarity_index = SimilarityIndex.build(db_session)
+        return similarity_index
+
+
+def similar_cities(city_id: uuid.UUID, k: int = 12) -> List[CityModel]:
+    return catalog.get_many([x for x, _ in get_similarity_index().similar(city_id, k)])
+
+
+def update_indexes():
+    """Adds newly ingested cities to whichever of the in-memory indexes have been built."""
+    with index_lock, sessions() as db_session:
+        if city_index is not None and city_index.load_new(db_session):
+            if city_sampler is not None:
+                city_sampler.rebuild()
+            if tag_index is not None:
+                tag_index.rebuild(db_session)
+        if similarity_index is not None:
+            similarity_index.load_new(db_session)
+
+
+async def warm_indexes():
+    """
+    Builds the city index and the sampler in a worker thread. Run at startup (NiceGUI runs it as a background task,
+    so it doesn't hold startup up), once for the process, so the first random city doesn't wait for them.
+    """
+    await run.io_bound(get_sampler)
+    logger.info("City index and sampler built.")
+
+
+def update_tags(tag: str, city_ids: List[uuid.UUID]):
+    """
+    After cities have been tagged outside the website (see tag_index.py), adds them to the tag index if it's been
+    built, and drops them from the catalog's cache so they're loaded again with their new tags.
+    """
+    catalog.forget(city_ids)
+    with index_lock:
+        if tag_index is not None:
+            tag_index.add(tag, city_ids)
+
+
+def random_city(facet=None, value=None, min_pop=None) -> Optional[CityModel]:
+    city_id = get_sampler().random(facet, value, min_pop)
+    return None if city_id is None else catalog.get(city_id)
+
+
+snapshot: Optional[Snapshot] = None
+
+
+def get_snapshot() -> Snapshot:
+    """The columnar snapshot, reloaded if ingest has added to it since it was last loaded."""
+    global snapshot
+    meta = read_meta(snapshot_dir)
+    if snapshot is None or snapshot.version != (meta["rows"], meta["last_rowid"]):
+        snapshot = Snapshot.load(snapshot_dir)
+    return snapshot
+
+
+def is_local(request: Request) -> bool:
+    return request.client is not None and request.client.host in ("127.0.0.1", "::1", "localhost")
+
+
+def city_file(city_hash: str) -> Optional[Path]:
+    """
+    Path to the .sc2 file for a city hash, for the download route.
+    Only if it's still the file that was ingested, the same size and mtime as its manifest entry for that hash.
+    Downloads are cached forever by hash, so a file that's been edited or replaced since mustn't be sent as that city.
+    """
+    with sessions() as db_session:
+        q = (
+            select(FileManifest.path, FileManifest.size, FileManifest.mtime_ns)
+            .join(DbCity, DbCity.city_path == FileManifest.path)
+            .where(DbCity.hash == city_hash, FileManifest.hash == city_hash)
+        )
+        row = db_session.execute(q).first()
+    if row is None:
+        return None
+    path, size, mtime_ns = row
+    try:
+        st = Path(path).stat()
+    except OSError:
+        return None
+    if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+        logger.warning(f"{path} has changed since it was ingested, not serving it for {city_hash}.")
+        return None
+    return Path(path)
+
+
+def add_api_routes(app):
+    """
+    Adds the routes that aren't pages: the watcher's and tagger's endpoints, metrics, the profiler, and the file, image
+    and OpenSeadragon routes.
+    Call it once, when the app is set up.
+    Args:
+        app (App): NiceGUI's app.
+    """
+
+    @app.post("/api/cities/ingested")
+    async def cities_ingested(request: Request):
+        """Called by the ingest watcher (watcher.py) when it's added new cities."""
+        if not is_local(request):
+            return JSONResponse({"error": "forbidden"}, status_code=403)
+        data = await request.json()
+        # The catalog loads cities on demand, so new ones are already visible. This just warms the cache.
+        added = len(await run.io_bound(catalog.get_many, [UUID(x) for x in data.get("ids", [])]))
+        logger.info(f"{added} new cities ingested.")
+        await run.io_bound(update_indexes)
+        await cities_added.call()
+        return {"added": added}
+
+    @app.post("/api/tags/changed")
+    async def tags_changed(request: Request):
+        """Called by tag_index.py after it's tagged cities, with the tag and the cities' ids."""
+        if not is_local(request):
+            return JSONResponse({"error": "forbidden"}, status_code=403)
+        data = await request.json()
+        city_ids = [UUID(x) for x in data.get("ids", [])]
+        await run.io_bound(update_tags, data["tag"], city_ids)
+        logger.info(f"{len(city_ids)} cities tagged {data['tag']}.")
+        return {"tagged": len(city_ids)}
+
+    @app.get("/metrics")
+    async def prometheus_metrics(request: Request):
+        """Handler and query latencies in the Prometheus text format. Local only, scrape it from the same machine."""
+        if not is_local(request):
+            return PlainTextResponse("forbidden", status_code=403)
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+    @app.get("/debug/profile")
+    async def profile(request: Request, seconds: float = 10.0):
+        """
+        Samples the event loop for a while and returns folded stacks, for flamegraph.pl or speedscope.
+        Only there when the server was started with SC2K_PROFILER=1.
+        """
+        if not profiler_enabled or not is_local(request):
+            return PlainTextResponse("not found", status_code=404)
+        # This runs on the event loop thread, which is the one to watch.
+        profiler = SamplingProfiler()
+        profiler.start()
+        await asyncio.sleep(min(max(seconds, 0.1), 60.0))
+        return PlainTextResponse(profiler.stop())
+
+    app.add_static_files('/cities', str(cities_dir))
+    app.add_static_files(openseadragon_url.rstrip("/"), str(openseadragon_dir))
+    add_routes(app, city_images, city_file)
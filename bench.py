@@ -0,0 +1,329 @@
+from typing import Any, Callable, Dict, List, Optional
+from pathlib import Path
+from random import Random
+from statistics import median
+from loguru import logger
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from PIL import Image
+from opencity2k.Data.value_mappings import disaster_type, weather_type
+
+from render import RenderContext
+from db import (
+    ParsedCity, create_db, create_session, session_factory, store_city, commit_batch, read_city_file, city_digest,
+    hash_algos, load_manifest, update_manifest, save_image_sizes, convert_date, rebuild_leaderboards, rebuild_facets, get_leaderboard,
+    top_cities, leaderboards, parse_city_bytes, render_city, city_attributes, batch_size, sprites_path, CityFeatures,
+)
+from features import feature_version, feature_length
+from similarity import SimilarityIndex
+from search import CityQuery, count_cities, search_cities, facet_counts, name_search
+from catalog import Catalog
+from city_index import CityIndex
+from sampler import CitySampler
+from tag_index import TagIndex, assign_tags
+
+# Named corpus sizes, --scale also takes a plain number.
+scales = {"1k": 1000, "10k": 10000, "100k": 100000}
+# Roughly the size of a real .sc2 file, so hashing reads a realistic amount.
+city_file_size = 40000
+# Words for the synthetic city names, so name search has something to match.
+name_words = ["new", "port", "san", "lake", "river", "north", "south", "east", "west", "city", "ville", "burg", "haven",
+              "spring", "falls", "hill", "bay", "rock", "green", "mill", "oak", "pine", "fort", "bridge"]
+# Ratio of the new to the old time above which --compare calls a result a regression.
+regression = 1.10
+
+
+def synthetic_city(rng: Random) -> Dict[str, Any]:
+    """A CityData row with values in the ranges real cities have."""
+    population = int(rng.paretovariate(1.2) * 1000)
+    arco_pop = rng.choice([0, 0, 0, 65000, 130000])
+    started = rng.randint(1900, 2050)
+    return {
+        "name": " ".join(rng.choice(name_words) for _ in range(rng.randint(1, 3))).title(),
+        "population": population,
+        "arco_pop": arco_pop,
+        "total_pop": population + arco_pop,
+        "started": started,
+        "date": convert_date(started, rng.randint(0, 300 * 100)),
+        "funds": rng.randint(-100000, 2 ** 31 - 1) if rng.random() < 0.01 else rng.randint(-10000, 500000),
+        "bonds": rng.randint(0, 50) * 10000,
+        "game_level": rng.randint(0, 3),
+        "city_status": rng.randint(0, 5),
+        "crime": rng.randint(0, 200),
+        "traffic": rng.randint(0, 200),
+        "pollution": rng.randint(0, 200),
+        "value": rng.randint(0, 500000),
+        "weather": str(rng.choice(list(weather_type))),
+        "nat_pop": rng.randint(0, 100000),
+        "nat_val": rng.randint(0, 1000000),
+        "disaster": rng.choice(list(disaster_type)) if rng.random() < 0.2 else 0,
+        "unemployment": rng.randint(0, 30),
+    }
+
+
+def make_corpus(out_dir: Path, n: int, seed: int) -> List[ParsedCity]:
+    """
+    Writes n fake city files, and makes a ParsedCity for each with synthetic CityData as if it had been parsed.
+    The files are random bytes, they're only good for hashing, not parsing.
+    """
+    rng = Random(seed)
+    cities_dir = out_dir / "cities"
+    cities_dir.mkdir(parents=True, exist_ok=True)
+    corpus = []
+    for i in range(n):
+        path = cities_dir / f"{i:06d}.sc2"
+        path.write_bytes(rng.randbytes(city_file_size))
+        city_id = uuid.UUID(int=rng.getrandbits(128), version=4)
+        corpus += [ParsedCity(path, uuid.uuid4().hex, "md5", city_id, out_dir / "city_images" / city_id.hex, synthetic_city(rng))]
+    return corpus
+
+
+def timed(fn: Callable, repeat: int = 1, ops: int = 1) -> Dict[str, float]:
+    """
+    Times fn, the best of repeat runs is the number to compare, the median shows how noisy it was.
+    Args:
+        fn (callable): what to time, called with no arguments.
+        repeat (int): number of runs.
+        ops (int): operations done by one call of fn, for a per-op time.
+    """
+    wall = []
+    cpu = []
+    for _ in range(repeat):
+        w, c = time.perf_counter(), time.process_time()
+        fn()
+        wall += [time.perf_counter() - w]
+        cpu += [time.process_time() - c]
+    best = min(wall)
+    return {
+        "best_s": best,
+        "median_s": median(wall),
+        "cpu_s": min(cpu),
+        "repeat": repeat,
+        "ops": ops,
+        "per_op_us": best / ops * 1e6,
+    }
+
+
+def bench_ingest(corpus: List[ParsedCity], p: Path, workdir: Path, images: int, image_size: tuple, cities: Optional[Path]) -> Dict[str, Any]:
+    """The ingest stages. Parsing and rendering need real city files, so they're only timed if cities is given."""
+    results = {}
+    files = [x.path for x in corpus]
+    for algo in hash_algos:
+        results[f"hash_{algo}"] = timed(lambda: [city_digest(read_city_file(x), algo) for x in files], ops=len(files))
+
+    create_db(p)
+    db_session = create_session(p)
+
+    def store():
+        for i in range(0, len(corpus), batch_size):
+            batch = corpus[i:i + batch_size]
+            for parsed in batch:
+                store_city(db_session, parsed)
+            update_manifest(db_session, [(x.path, x.path.stat(), x.city_hash) for x in batch])
+            commit_batch(db_session, batch)
+    results["store_commit"] = timed(store, ops=len(corpus))
+    results["manifest_load"] = timed(lambda: load_manifest(db_session), repeat=3, ops=len(corpus))
+    results["stat_files"] = timed(lambda: [x.stat() for x in files], repeat=3, ops=len(files))
+    results["rebuild_facets"] = timed(lambda: rebuild_facets(db_session), repeat=3)
+    results["rebuild_leaderboards"] = timed(lambda: rebuild_leaderboards(db_session), repeat=3)
+    db_session.close()
+
+    rng = Random(0)
+    img = Image.frombytes("RGB", image_size, rng.randbytes(image_size[0] * image_size[1] * 3))
+    out_dir = workdir / "city_images"
+    out_dir.mkdir(exist_ok=True)
+    results["image_sizes"] = timed(lambda: [save_image_sizes(img, out_dir / uuid.uuid4().hex) for _ in range(images)], ops=images)
+
+    if cities is not None:
+        real = sorted(cities.rglob("*.sc2"))[:images]
+        parsed = []
+
+        def parse():
+            parsed.clear()
+            for c in real:
+                try:
+                    parsed.append(parse_city_bytes(read_city_file(c), c))
+                except Exception as e:
+                    logger.warning(f"Couldn't parse {c}: {e}")
+        results["parse"] = timed(parse, ops=max(1, len(real)))
+        results["city_attributes"] = timed(lambda: [city_attributes(x) for x in parsed], repeat=3, ops=max(1, len(parsed)))
+        render_ctx = RenderContext.load(sprites_path)
+        results["render"] = timed(lambda: [render_city(x, out_dir / uuid.uuid4().hex, render_ctx) for x in parsed], ops=max(1, len(parsed)))
+    return results
+
+
+def bench_queries(p: Path, n: int, seed: int) -> Dict[str, Any]:
+    """Catalog, search, ranking, random picks and tags, against the database bench_ingest() made."""
+    results = {}
+    rng = Random(seed)
+    sessions = session_factory(p)
+    db_session = create_session(p)
+
+    catalog = Catalog(sessions, Path("city_images"), cache_size=n)
+    results["catalog_count"] = timed(catalog.count, repeat=5)
+    pages = min(50, max(1, n // 48))
+    results["catalog_page"] = timed(lambda: [catalog.page(x, 48) for x in range(pages)], ops=pages)
+    results["catalog_page_warm"] = timed(lambda: [catalog.page(x, 48) for x in range(pages)], repeat=3, ops=pages)
+    some_ids = [x.city_id for x in catalog.page(0, 1000)]
+    catalog = Catalog(sessions, Path("city_images"), cache_size=n)
+    results["catalog_get_many_cold"] = timed(lambda: catalog.get_many(some_ids), ops=len(some_ids))
+    results["catalog_get_many_warm"] = timed(lambda: catalog.get_many(some_ids), repeat=5, ops=len(some_ids))
+
+    queries = []
+    for _ in range(20):
+        equals = {"disaster": rng.choice(list(disaster_type))} if rng.random() < 0.5 else {}
+        ranges = {"total_pop": (rng.choice([0, 1000, 10000, 100000]), None)}
+        queries += [CityQuery(equals, ranges)]
+    results["search_count"] = timed(lambda: [count_cities(db_session, q) for q in queries], repeat=3, ops=len(queries))
+    results["search_page"] = timed(lambda: [search_cities(db_session, q, 0, 48, count=False) for q in queries], repeat=3, ops=len(queries))
+    # Page 21, carrying on from where page 20 ended like the gallery does.
+    deep = [search_cities(db_session, q, 19, 48, count=False).last_rowid for q in queries]
+    results["search_deep_page"] = timed(lambda: [search_cities(db_session, q, 20, 48, count=False, after=a) for q, a in zip(queries, deep)], repeat=3, ops=len(queries))
+    results["facet_counts_all"] = timed(lambda: facet_counts(db_session), repeat=5)
+    results["facet_counts_filtered"] = timed(lambda: [facet_counts(db_session, q) for q in queries], repeat=3, ops=len(queries))
+    prefixes = [w[:k] for w in name_words for k in (1, 3)]
+    results["name_search"] = timed(lambda: [name_search(db_session, x) for x in prefixes], repeat=3, ops=len(prefixes))
+
+    results["ranking_top"] = timed(lambda: [top_cities(db_session, x) for x in leaderboards], repeat=3, ops=len(leaderboards))
+    results["ranking_stored"] = timed(lambda: [get_leaderboard(db_session, x) for x in leaderboards], repeat=5, ops=len(leaderboards))
+
+    index = None
+
+    def build_index():
+        nonlocal index
+        index = CityIndex.build(db_session)
+    results["city_index_build"] = timed(build_index, ops=n)
+    sampler = None
+
+    def build_sampler():
+        nonlocal sampler
+        sampler = CitySampler(index)
+    results["sampler_build"] = timed(build_sampler, repeat=3, ops=n)
+    picks = 10000
+    results["random_pick"] = timed(lambda: [sampler.random() for _ in range(picks)], repeat=3, ops=picks)
+    results["random_pick_filtered"] = timed(lambda: [sampler.random("disaster", 1, 10000) for _ in range(picks)], repeat=3, ops=picks)
+    results["random_pick_catalog"] = timed(lambda: [catalog.get(sampler.random()) for _ in range(100)], repeat=3, ops=100)
+
+    tagged = [index.city_id(x) for x in range(0, len(index), 3)]
+    results["assign_tags"] = timed(lambda: assign_tags(db_session, "Bench", tagged), ops=max(1, len(tagged)))
+    tags = None
+
+    def build_tags():
+        nonlocal tags
+        tags = TagIndex.build(db_session, index)
+    results["tag_index_build"] = timed(build_tags, repeat=3)
+    results["tag_query"] = timed(lambda: tags.count(tags.query(all_of=["Bench"])), repeat=5)
+    results["tag_page"] = timed(lambda: tags.city_ids(tags.query(all_of=["Bench"]), 0, 48), repeat=5)
+
+    # Random vectors, real ones need real cities. Query time only depends on how many there are.
+    db_session.add_all([
+        CityFeatures(id=index.city_id(i), version=feature_version, vector=rng.randbytes(feature_length)) for i in range(len(index))
+    ])
+    db_session.commit()
+    similar = None
+
+    def build_similar():
+        nonlocal similar
+        similar = SimilarityIndex.build(db_session)
+    results["similarity_build"] = timed(build_similar, ops=n)
+    probes = [index.city_id(rng.randrange(len(index))) for _ in range(20)]
+    results["similarity_query"] = timed(lambda: [similar.similar(x, 12) for x in probes], repeat=3, ops=len(probes))
+    db_session.close()
+    return results
+
+
+def bench_misc() -> Dict[str, Any]:
+    results = {}
+    rng = Random(0)
+    dates = [(rng.randint(1900, 2050), rng.randint(0, 300 * 100)) for _ in range(100000)]
+    results["convert_date"] = timed(lambda: [convert_date(y, c) for y, c in dates], repeat=3, ops=len(dates))
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(n: int, seed: int, images: int, image_size: tuple, cities: Optional[Path], keep: Optional[Path]) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix="sc2k-bench-") as tmp:
+        workdir = keep or Path(tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+        p = workdir / "bench.sqlite"
+        if p.exists():
+            p.unlink()
+        start = time.perf_counter()
+        corpus = make_corpus(workdir, n, seed)
+        logger.info(f"Made {n} synthetic cities in {time.perf_counter() - start:.1f}s.")
+        results = {}
+        results.update(bench_ingest(corpus, p, workdir, images, image_size, cities))
+        results.update(bench_queries(p, n, seed))
+        results.update(bench_misc())
+    return {
+        "meta": {
+            "cities": n,
+            "seed": seed,
+            "images": images,
+            "image_size": list(image_size),
+            "real_cities": None if cities is None else str(cities),
+            "commit": git_commit(),
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "hash_algos": sorted(hash_algos),
+        },
+        "results": results,
+    }
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]) -> List[str]:
+    """Lines comparing two runs' best times, with regressions marked. Only benchmarks in both are compared."""
+    lines = []
+    if old["meta"]["cities"] != new["meta"]["cities"]:
+        lines += [f"Warning: comparing {old['meta']['cities']} cities with {new['meta']['cities']}."]
+    for name, res in new["results"].items():
+        if name not in old["results"]:
+            continue
+        ratio = res["best_s"] / max(old["results"][name]["best_s"], 1e-9)
+        flag = " REGRESSION" if ratio > regression else ""
+        lines += [f"{name:28} {old['results'][name]['best_s'] * 1000:10.2f}ms -> {res['best_s'] * 1000:10.2f}ms  x{ratio:.2f}{flag}"]
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks ingest, catalog, search, ranking and random picks on a synthetic corpus. Doesn't need a network.")
+    parser.add_argument("-s", "--scale", default="1k", help=f"Number of cities, one of {', '.join(scales)} or a number.")
+    parser.add_argument("-o", "--out", type=Path, help="Where to write the results, default bench_<scale>.json.")
+    parser.add_argument("-c", "--compare", type=Path, help="Results of an earlier run to compare against.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic corpus.")
+    parser.add_argument("--images", type=int, default=10, help="Number of renders to time image resizing (and parsing and rendering) on.")
+    parser.add_argument("--image-size", type=int, nargs=2, default=(2048, 1024), metavar=("W", "H"), help="Size of the synthetic render.")
+    parser.add_argument("--cities", type=Path, help="Directory of real .sc2 files, to also time parsing and rendering.")
+    parser.add_argument("--keep", type=Path, help="Build the corpus and database here and keep them, instead of a temporary directory.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the ingest logging.")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.remove()
+        logger.add(sys.stderr, level="WARNING")
+    n = scales[args.scale] if args.scale in scales else int(args.scale)
+    res = run(n, args.seed, args.images, tuple(args.image_size), args.cities, args.keep)
+    out = args.out or Path(f"bench_{args.scale}.json")
+    out.write_text(json.dumps(res, indent=2))
+    for name, r in res["results"].items():
+        print(f"{name:28} {r['best_s'] * 1000:10.2f}ms  {r['per_op_us']:12.1f}us/op")
+    print(f"Wrote {out}")
+    if args.compare is not None:
+        print("\n".join(compare(json.loads(args.compare.read_text()), res)))
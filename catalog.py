@@ -0,0 +1,92 @@
+from typing import List, Optional, Iterable
+from pathlib import Path
+from collections import OrderedDict
+from threading import Lock
+from attrs import define, field, Factory
+from sqlalchemy import select, func, literal_column
+from sqlalchemy.orm import sessionmaker, selectinload
+import uuid
+
+from db import City, CityData, CityTags
+from models import CityModel
+
+cache_size = 1024
+
+
+@define
+class Catalog:
+    """
+    Cities, loaded from the database as they're asked for rather than all at startup.
+    The most recently used are kept hydrated in a bounded LRU, so memory use doesn't grow with the archive.
+    Each city is loaded with a single joined query over cities and city_data, plus one for the tags of a whole batch.
+    Every call uses its own short lived session, so it's safe to call from worker threads. Cached cities are detached
+    from any session, which is why their tags are loaded up front rather than lazily.
+    """
+    sessions: sessionmaker
+    city_images: Path
+    cache_size: int = cache_size
+    _cache: OrderedDict = field(init=False, default=Factory(OrderedDict))
+    _lock: Lock = field(init=False, default=Factory(Lock))
+
+    def _select(self):
+        q = select(City, CityData).join(CityData, City.id == CityData.id)
+        return q.options(selectinload(City.city_tags).selectinload(CityTags.tag))
+
+    def hydrate(self, db_city: City, db_data: CityData) -> CityModel:
+        """Wraps database rows in a CityModel, reusing the cached one if there is one."""
+        with self._lock:
+            model = self._cache.get(db_city.id)
+            if model is None:
+                model = CityModel(db_city.id, db_city, db_data, self.city_images)
+                self._cache[db_city.id] = model
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.move_to_end(db_city.id)
+            return model
+
+    def _cached(self, city_id: uuid.UUID) -> Optional[CityModel]:
+        with self._lock:
+            model = self._cache.get(city_id)
+            if model is not None:
+                self._cache.move_to_end(city_id)
+            return model
+
+    def forget(self, city_ids: Iterable[uuid.UUID]):
+        """Drops cities from the cache, so they're loaded again next time, e.g. after their tags have changed."""
+        with self._lock:
+            for x in city_ids:
+                self._cache.pop(x, None)
+
+    def get(self, city_id: uuid.UUID) -> Optional[CityModel]:
+        model = self._cached(city_id)
+        if model is not None:
+            return model
+        with self.sessions() as db_session:
+            row = db_session.execute(self._select().where(City.id == city_id)).first()
+            return None if row is None else self.hydrate(*row)
+
+    def get_many(self, city_ids: Iterable[uuid.UUID]) -> List[CityModel]:
+        """Cities by id, in the order asked for. Any that aren't cached are loaded with one query."""
+        city_ids = list(city_ids)
+        found = {}
+        for x in city_ids:
+            model = self._cached(x)
+            if model is not None:
+                found[x] = model
+        missing = [x for x in city_ids if x not in found]
+        if missing:
+            with self.sessions() as db_session:
+                for db_city, db_data in db_session.execute(self._select().where(City.id.in_(missing))):
+                    found[db_city.id] = self.hydrate(db_city, db_data)
+        return [found[x] for x in city_ids if x in found]
+
+    def page(self, page: int, page_size: int) -> List[CityModel]:
+        """A page of cities in the order they were added, starting from page 0."""
+        q = self._select().order_by(literal_column("city_data.rowid")).limit(page_size).offset(page * page_size)
+        with self.sessions() as db_session:
+            return [self.hydrate(*x) for x in db_session.execute(q)]
+
+    def count(self) -> int:
+        with self.sessions() as db_session:
+            return db_session.scalar(select(func.count()).select_from(City))
@@ -0,0 +1,99 @@
+from typing import Dict, Optional
+from array import array
+from bisect import bisect_left
+from attrs import define, field, Factory
+from loguru import logger
+from sqlalchemy import select, literal_column
+import uuid
+
+from db import CityData
+
+# The numeric CityData fields kept in the index, and the array typecode to store each in.
+# q is 8 bytes, i is 4 and h is 2. Weather is stored as a string in the db, but is always a number.
+index_fields = {
+    "population": "q",
+    "arco_pop": "q",
+    "total_pop": "q",
+    "funds": "q",
+    "bonds": "q",
+    "value": "q",
+    "nat_pop": "q",
+    "nat_val": "q",
+    "started": "i",
+    "crime": "i",
+    "traffic": "i",
+    "pollution": "i",
+    "unemployment": "i",
+    "game_level": "h",
+    "city_status": "h",
+    "weather": "h",
+    "disaster": "h",
+}
+# Bytes per city: the fields above, the 16 byte id and 8 bytes for the id lookup.
+bytes_per_city = sum(array(x).itemsize for x in index_fields.values()) + 16 + 8
+
+
+@define
+class CityIndex:
+    """
+    Read-only, compact copy of the numeric CityData fields for every city, for things that need the whole catalog in memory.
+    Cities are numbered by a dense ordinal (the order they were added), and each field is a flat array indexed by it.
+    Ids are packed 16 bytes each into one bytearray, so there's no per-city Python object at all.
+    Memory budget is bytes_per_city per city (about 116 bytes, or ~12MB for 100k cities), plus a little array slack.
+    """
+    ids: bytearray = field(default=Factory(bytearray))
+    columns: Dict[str, array] = field(default=Factory(lambda: {k: array(v) for k, v in index_fields.items()}))
+    # Ordinals sorted by id, to look up an id with a binary search.
+    _by_id: array = field(init=False, default=Factory(lambda: array("q")))
+    _last_rowid: int = field(init=False, default=0)
+
+    @classmethod
+    def build(cls, db_session):
+        """Builds the index in a single pass over city_data, without making any ORM objects."""
+        index = cls()
+        index.load_new(db_session)
+        return index
+
+    def load_new(self, db_session) -> int:
+        """Adds any cities added to the database since the index was built. Returns how many were added."""
+        rowid = literal_column("city_data.rowid")
+        cols = [getattr(CityData, x) for x in index_fields]
+        q = select(rowid, CityData.id, *cols).where(rowid > self._last_rowid).order_by(rowid)
+        n = 0
+        for row in db_session.execute(q.execution_options(yield_per=10000)):
+            self._last_rowid = row[0]
+            self.ids += row[1].bytes
+            for name, value in zip(index_fields, row[2:]):
+                self.columns[name].append(int(value))
+            n += 1
+        if n:
+            self._by_id = array("q", sorted(range(len(self)), key=self._id_bytes))
+            logger.info(f"Indexed {n} cities, {len(self)} total, {self.nbytes() / 1e6:.1f}MB.")
+        return n
+
+    def __len__(self) -> int:
+        return len(self.ids) // 16
+
+    def _id_bytes(self, ordinal: int) -> bytes:
+        return bytes(self.ids[ordinal * 16:(ordinal + 1) * 16])
+
+    def city_id(self, ordinal: int) -> uuid.UUID:
+        return uuid.UUID(bytes=self._id_bytes(ordinal))
+
+    def ordinal(self, city_id: uuid.UUID) -> Optional[int]:
+        """Ordinal for a city id, or None if it isn't in the index."""
+        key = city_id.bytes
+        i = bisect_left(self._by_id, key, key=self._id_bytes)
+        if i < len(self._by_id) and self._id_bytes(self._by_id[i]) == key:
+            return self._by_id[i]
+        return None
+
+    def column(self, name: str) -> array:
+        return self.columns[name]
+
+    def row(self, ordinal: int) -> Dict[str, int]:
+        """All the indexed fields for one city."""
+        return {k: v[ordinal] for k, v in self.columns.items()}
+
+    def nbytes(self) -> int:
+        return len(self.ids) + sum(len(x) * x.itemsize for x in self.columns.values()) + len(self._by_id) * self._by_id.itemsize
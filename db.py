@@ -1,13 +1,33 @@
 from typing import Dict, Any, List, Union, Optional
 from pathlib import Path
-from sqlalchemy import ForeignKey, String, UUID, create_engine, JSON, ForeignKey
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, Session
+from sqlalchemy import ForeignKey, String, UUID, create_engine, JSON, ForeignKey, event, select, inspect, text, func, delete, Index
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, Session, sessionmaker
 import uuid
 from loguru import logger
 import os
 from PIL import Image
 import hashlib
-
+import tempfile
+import multiprocessing
+import threading
+from collections import Counter
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from attrs import define, field
+import time
+
+from render import RenderContext
+from tiles import make_pyramid, dzi_file
+from ingest_stats import IngestStats, stage, status_file
+from features import city_features, feature_version
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 import opencity2k.sc2_parse as sc2p
 import opencity2k.city_preview as cp
 
@@ -17,7 +37,42 @@ city_images = Path("city_images")
 sprites_path = Path("sprites")
 db_dir = Path("db")
 db_fn = "sc2k.sqlite"
+# Connections in the website's pool, see session_factory().
+pool_size = 8
 thumb_width = 300
+# Extra images made from each render, name: (width, file name suffix). A width of None is full size.
+image_sizes = {
+    "gallery": (thumb_width, "_t"),
+    "card": (600, "_c"),
+    "full": (None, ""),
+}
+# Formats to write each size in. avif is skipped if Pillow wasn't built with it.
+image_formats = ["jpg", "webp"]
+image_save_options = {
+    "jpg": {"quality": 85, "optimize": True},
+    "webp": {"quality": 80, "method": 4},
+    "avif": {"quality": 60},
+}
+# Arguments to render_city_image() after the city: transparent_bg, hide_edges, hide_zones, file type.
+render_options = (False, True, False, "jpg")
+# Bump this when render_city() changes what it outputs, to invalidate the render cache.
+render_version = 1
+# Columns with precomputed counts per value, see FacetCount.
+facet_columns = ["disaster", "weather"]
+# Top-N tables for the Ranking tab, name: (CityData column, exclusive upper limit or None).
+# Funds of 0x7fffffff are a sentinel, not real money.
+leaderboards = {
+    "population": ("total_pop", None),
+    "funds": ("funds", 0x7fffffff),
+    "crime": ("crime", None),
+    "value": ("value", None),
+}
+leaderboard_size = 10
+# FTS5 index over city names, source paths and tag names. Prefix indexes make short autocomplete queries cheap.
+fts_table = "city_fts"
+batch_size = 500
+# Which digest to identify city files by. MD5 should be fine for this, blake2b and xxh3 are faster.
+hash_algo = "md5"
 
 def convert_date(base_year, cycles):
     """
@@ -36,12 +91,51 @@ def convert_date(base_year, cycles):
     return f"{month_lookup[month]} {day}, {year}"
 
 
-def file_hash(filename: Path) -> str:
+# All of these produce 128 bit digests, so they take the same space in the db.
+# Can always switch to SHA256, which will take 2x the storage.
+hash_algos = {
+    "md5": lambda data: hashlib.md5(data).hexdigest(),
+    "blake2b": lambda data: hashlib.blake2b(data, digest_size=16).hexdigest(),
+}
+if xxhash is not None:
+    hash_algos["xxh3"] = xxhash.xxh3_128_hexdigest
+
+
+def city_digest(data: bytes, algo: str = hash_algo) -> str:
+    """Hashes the contents of a city file with one of hash_algos."""
+    return hash_algos[algo](data)
+
+
+def read_city_file(filename: Path) -> bytes:
+    """Reads a whole city file. Cities are small, so it's cheaper to read it once and hash and parse from memory."""
     with open(filename, 'rb', buffering=0) as f:
-        # MD5 should be fine for this.
-        # Can always switch to SHA256, which will take 2x the storage.
-        h = hashlib.file_digest(f, "md5")
-        return h.hexdigest()
+        return f.readall()
+
+
+def file_hash(filename: Path, algo: str = hash_algo) -> str:
+    return city_digest(read_city_file(filename), algo)
+
+
+# Prefer a RAM backed location for the parser's copy of the file, if there is one.
+_parse_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def parse_city_bytes(data: bytes, filename: Path):
+    """
+    Parses a city from the contents of its file.
+    The parser only takes paths, so this hands it a copy in a (memory backed, where possible) temp dir rather than re-reading the original.
+    Args:
+        data (bytes): contents of the .sc2 file.
+        filename (Path): where the file came from. The name is kept, in case the parser falls back on it.
+    Returns:
+        sc2p.City
+    """
+    with tempfile.TemporaryDirectory(dir=_parse_dir) as tmp:
+        tmp_path = Path(tmp) / Path(filename).name
+        tmp_path.write_bytes(data)
+        city = sc2p.City()
+        city.create_city_from_file(tmp_path)
+    return city
 
 
 class Base(DeclarativeBase):
@@ -54,7 +148,8 @@ class City(Base):
     __tablename__ = "cities"
 
     id: Mapped[uuid.UUID] = mapped_column(primary_key=True)
-    hash: Mapped[str]
+    hash: Mapped[str] = mapped_column(index=True, unique=True)
+    hash_algo: Mapped[str] = mapped_column(default="md5", server_default="md5")
     city_path: Mapped[str]
     image_path: Mapped[str]
     city_tags: Mapped[List["CityTags"]] = relationship(back_populates="city")
@@ -67,22 +162,39 @@ class CityData(Base):
     name: Mapped[str]
     population: Mapped[int]
     arco_pop: Mapped[int]
-    started: Mapped[int]
+    # population + arco_pop, stored so it can be indexed.
+    total_pop: Mapped[int] = mapped_column(index=True, server_default="0")
+    started: Mapped[int] = mapped_column(index=True)
     date: Mapped[int]
-    funds: Mapped[int]
+    funds: Mapped[int] = mapped_column(index=True)
     bonds: Mapped[int]
-    game_level: Mapped[int]
-    city_status: Mapped[int]
-    crime: Mapped[int]
+    game_level: Mapped[int] = mapped_column(index=True)
+    city_status: Mapped[int] = mapped_column(index=True)
+    crime: Mapped[int] = mapped_column(index=True)
     traffic: Mapped[int]
-    pollution: Mapped[int]
-    value: Mapped[int]
-    weather: Mapped[str]
+    pollution: Mapped[int] = mapped_column(index=True)
+    value: Mapped[int] = mapped_column(index=True)
+    weather: Mapped[str] = mapped_column(index=True)
     nat_pop: Mapped[int]
     nat_val: Mapped[int]
-    disaster: Mapped[int]
+    disaster: Mapped[int] = mapped_column(index=True)
     unemployment: Mapped[int]
 
+    # For the common search of a disaster/weather with a population range.
+    __table_args__ = (
+        Index("ix_city_data_disaster_total_pop", "disaster", "total_pop"),
+        Index("ix_city_data_weather_total_pop", "weather", "total_pop"),
+    )
+
+
+class FacetCount(Base):
+    """Number of cities with each value of the facet_columns, kept up to date by ingest so the UI doesn't need a GROUP BY."""
+    __tablename__ = "facet_counts"
+
+    facet: Mapped[str] = mapped_column(primary_key=True)
+    value: Mapped[str] = mapped_column(primary_key=True)
+    count: Mapped[int]
+
 
 class Tags(Base):
     __tablename__ = "tags"
@@ -98,126 +210,732 @@ class CityTags(Base):
     id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
 
     tag_id: Mapped[uuid.UUID] = mapped_column(ForeignKey("tags.id"))
-    city_id: Mapped[uuid.UUID] = mapped_column(ForeignKey("cities.id"))
+    city_id: Mapped[uuid.UUID] = mapped_column(ForeignKey("cities.id"), index=True)
     tag: Mapped["Tags"] = relationship(back_populates="city_tags")
     city: Mapped["City"] = relationship(back_populates="city_tags")
 
+    # A city has each tag at most once, and this also covers looking up a tag's cities.
+    __table_args__ = (
+        Index("ix_city_tags_tag_id_city_id", "tag_id", "city_id", unique=True),
+    )
+
+
+class FileManifest(Base):
+    """What each file looked like when it was last hashed, so unchanged files can be skipped without reading them."""
+    __tablename__ = "file_manifest"
+
+    path: Mapped[str] = mapped_column(primary_key=True)
+    size: Mapped[int]
+    mtime_ns: Mapped[int]
+    hash: Mapped[str]
+
+
+class CityFeatures(Base):
+    """Layout feature vector for each city, packed one byte per value, see features.city_features()."""
+    __tablename__ = "city_features"
+
+    id: Mapped[uuid.UUID] = mapped_column(ForeignKey("cities.id"), primary_key=True)
+    version: Mapped[int]
+    vector: Mapped[bytes]
+
+
+class Leaderboard(Base):
+    """Materialized top leaderboard_size cities for each of the leaderboards, kept up to date by ingest."""
+    __tablename__ = "leaderboards"
+
+    board: Mapped[str] = mapped_column(primary_key=True)
+    rank: Mapped[int] = mapped_column(primary_key=True)
+    city_id: Mapped[uuid.UUID]
+    name: Mapped[str]
+    score: Mapped[int]
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Tunes each new SQLite connection for bulk writes. WAL keeps readers (the website) from blocking the writer."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # NORMAL is still crash safe in WAL mode, it just might lose the last transaction on power loss.
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    # Negative is in KiB, so 64MB.
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def sqlite_engine(db_path, echo=False, **kwargs):
+    engine = create_engine(f"sqlite:///{db_path}", echo=echo, **kwargs)
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
+
+def create_indexes(engine):
+    """create_all() only makes indexes for new tables, so this adds any that are missing from an existing database."""
+    for table in Base.metadata.sorted_tables:
+        for idx in table.indexes:
+            idx.create(engine, checkfirst=True)
+
+
+def add_missing_columns(engine):
+    """create_all() won't add columns to existing tables either. New columns need a server_default or to be nullable."""
+    insp = inspect(engine)
+    added = []
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+            existing = {x["name"] for x in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name not in existing:
+                    logger.info(f"Adding column {col.name} to {table.name}.")
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {CreateColumn(col).compile(dialect=engine.dialect)}"))
+                    added += [(table.name, col.name)]
+    return added
+
+
+def update_facets(db_session, rows: List[Dict[str, Any]]):
+    """Adds the values in rows (CityData column name to value) to the facet counts. Doesn't commit."""
+    counts = Counter((f, str(x[f])) for x in rows for f in facet_columns)
+    for (facet, value), count in counts.items():
+        q = sqlite_insert(FacetCount).values(facet=facet, value=value, count=count)
+        q = q.on_conflict_do_update(index_elements=["facet", "value"], set_={"count": FacetCount.count + count})
+        db_session.execute(q)
+
+
+def top_cities(db_session, board: str, n: int = leaderboard_size) -> List[tuple]:
+    """Top n (id, name, score) for a leaderboard, straight from city_data. Each column is indexed, so this doesn't sort."""
+    col_name, limit = leaderboards[board]
+    col = getattr(CityData, col_name)
+    q = select(CityData.id, CityData.name, col)
+    if limit is not None:
+        q = q.where(col < limit)
+    return [tuple(x) for x in db_session.execute(q.order_by(col.desc()).limit(n))]
+
+
+def _set_leaderboard(db_session, board: str, rows: List[tuple]):
+    db_session.execute(delete(Leaderboard).where(Leaderboard.board == board))
+    for rank, (city_id, name, score) in enumerate(rows):
+        db_session.add(Leaderboard(board=board, rank=rank, city_id=city_id, name=name, score=score))
+
+
+def rebuild_leaderboards(db_session, n: int = leaderboard_size):
+    """Recomputes all the leaderboards from scratch."""
+    for board in leaderboards:
+        _set_leaderboard(db_session, board, top_cities(db_session, board, n))
+    db_session.commit()
+
+
+def get_leaderboard(db_session, board: str) -> List[tuple]:
+    """The stored (id, name, score) rows for a leaderboard, best first."""
+    q = select(Leaderboard.city_id, Leaderboard.name, Leaderboard.score).where(Leaderboard.board == board).order_by(Leaderboard.rank)
+    return [tuple(x) for x in db_session.execute(q)]
+
+
+def update_leaderboards(db_session, rows: List[Dict[str, Any]], n: int = leaderboard_size):
+    """
+    Merges new cities into the leaderboards, only rewriting the ones that change. Doesn't commit.
+    Args:
+        rows (list): CityData column name to value for each new city, including id.
+    """
+    for board, (col, limit) in leaderboards.items():
+        new = [(x["id"], x["name"], x[col]) for x in rows if limit is None or x[col] < limit]
+        if not new:
+            continue
+        current = get_leaderboard(db_session, board)
+        top = sorted(current + new, key=lambda x: x[2], reverse=True)[:n]
+        if top != current:
+            _set_leaderboard(db_session, board, top)
+
+
+def rebuild_facets(db_session):
+    """Recounts the facets from scratch."""
+    db_session.execute(delete(FacetCount))
+    for facet in facet_columns:
+        col = getattr(CityData, facet)
+        for value, count in db_session.execute(select(col, func.count()).group_by(col)):
+            db_session.add(FacetCount(facet=facet, value=str(value), count=count))
+    db_session.commit()
+
+
+def create_fts(engine):
+    """
+    Creates the full text index. It's a virtual table, so it isn't part of Base.metadata.
+    Each city's row has the same rowid as its city_data row, so it can be found without a scan (city_id is UNINDEXED).
+    """
+    with engine.begin() as conn:
+        conn.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} "
+            "USING fts5(name, city_path, tags, city_id UNINDEXED, prefix='2 3')"
+        ))
+
+
+def update_fts(db_session, rows: List[Dict[str, Any]]):
+    """
+    Adds cities to the full text index. rows have city_id, name, city_path and tags.
+    Their city_data rows have to be in already (flushed), for the rowid. Doesn't commit.
+    """
+    if not rows:
+        return
+    db_session.flush()
+    db_session.execute(
+        text(
+            f"INSERT INTO {fts_table} (rowid, city_id, name, city_path, tags) "
+            "VALUES ((SELECT rowid FROM city_data WHERE id = :city_id), :city_id, :name, :city_path, :tags)"
+        ),
+        [dict(x, city_id=x["city_id"].hex) for x in rows],
+    )
+
+
+def update_fts_tags(db_session, city_ids: List[uuid.UUID]):
+    """
+    Refreshes the tags column of the full text index for some cities, after their tags change. Doesn't commit.
+    Each row is found by rowid and its tags by the index on city_tags.city_id, so this doesn't depend on how many cities there are.
+    """
+    if not city_ids:
+        return
+    db_session.execute(
+        text(
+            f"UPDATE {fts_table} SET tags = coalesce((SELECT group_concat(tags.name, ' ') FROM city_tags "
+            "JOIN tags ON tags.id = city_tags.tag_id WHERE city_tags.city_id = :city_id), '') "
+            "WHERE rowid = (SELECT rowid FROM city_data WHERE id = :city_id)"
+        ),
+        [{"city_id": x.hex} for x in city_ids],
+    )
+
+
+def rebuild_fts(db_session):
+    """Rebuilds the full text index from scratch."""
+    db_session.execute(text(f"DELETE FROM {fts_table}"))
+    db_session.execute(text(
+        f"INSERT INTO {fts_table} (rowid, city_id, name, city_path, tags) "
+        "SELECT city_data.rowid, cities.id, city_data.name, cities.city_path, coalesce((SELECT group_concat(tags.name, ' ') "
+        "FROM city_tags JOIN tags ON tags.id = city_tags.tag_id WHERE city_tags.city_id = cities.id), '') "
+        "FROM cities JOIN city_data ON city_data.id = cities.id"
+    ))
+    db_session.commit()
+
+
+def fts_rowids_match(db_session) -> bool:
+    """Whether every row of the full text index has its city's city_data rowid, older databases didn't."""
+    mismatched = db_session.scalar(text(
+        f"SELECT count(*) FROM {fts_table} LEFT JOIN city_data ON city_data.rowid = {fts_table}.rowid "
+        f"WHERE city_data.id IS NOT {fts_table}.city_id"
+    ))
+    return mismatched == 0
+
 
 def create_db(db_path):
-    engine = create_engine(f"sqlite:///{db_path}", echo=True)
+    engine = sqlite_engine(db_path, echo=True)
     Base.metadata.create_all(engine)
+    added = add_missing_columns(engine)
+    if ("city_data", "total_pop") in added:
+        with engine.begin() as conn:
+            conn.execute(text("UPDATE city_data SET total_pop = population + arco_pop"))
+    if "ix_city_tags_tag_id_city_id" not in {x["name"] for x in inspect(engine).get_indexes("city_tags")}:
+        # Drop any repeated tags, or the unique index can't be made.
+        with engine.begin() as conn:
+            conn.execute(text("DELETE FROM city_tags WHERE rowid NOT IN (SELECT min(rowid) FROM city_tags GROUP BY tag_id, city_id)"))
+    create_indexes(engine)
+    create_fts(engine)
+    with Session(engine) as db_session:
+        if db_session.scalar(select(func.count()).select_from(FacetCount)) == 0:
+            rebuild_facets(db_session)
+        if db_session.scalar(select(func.count()).select_from(Leaderboard)) == 0:
+            rebuild_leaderboards(db_session)
+        if db_session.scalar(text(f"SELECT count(*) FROM {fts_table}")) == 0 or not fts_rowids_match(db_session):
+            rebuild_fts(db_session)
+
+@define
+class ParsedCity:
+    """Result of parsing and rendering a single city file, as returned by an ingest worker."""
+    path: Path
+    city_hash: str
+    hash_algo: str
+    city_id: Optional[uuid.UUID] = None
+    image_path: Optional[Path] = None
+    data: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    # Set if the hash was already known to the worker, so it wasn't parsed or rendered.
+    duplicate: bool = False
+    # Stage name to (wall, cpu) seconds spent on this city in the worker, see ingest_stats.
+    timings: Dict[str, tuple] = field(factory=dict)
+    # Packed layout vector, empty if the city's tiles couldn't be read.
+    features: bytes = b""
+
+
+def city_attributes(city) -> Dict[str, Any]:
+    """
+    Pulls out the attributes stored in CityData from a parsed city.
+    Args:
+        city (sc2p.City): parsed city.
+    Returns:
+        Dictionary of CityData column name to value.
+    """
+    start_year = city.city_attributes["baseYear"]
+    return {
+        "name": city.city_name,
+        "population": city.city_attributes['TotalPop'],
+        "arco_pop": city.city_attributes['GlobalArcoPop'],
+        "total_pop": city.city_attributes['TotalPop'] + city.city_attributes['GlobalArcoPop'],
+        "started": start_year,
+        "date": convert_date(start_year, city.city_attributes["simCycle"]),
+        "funds": city.city_attributes['TotalFunds'],
+        "bonds": city.city_attributes['TotalBonds'],
+        "game_level": city.city_attributes['GameLevel'],
+        "city_status": city.city_attributes['CityStatus'],
+        "crime": city.city_attributes['CrimeCount'],
+        "traffic": city.city_attributes['TrafficCount'],
+        "pollution": city.city_attributes['Pollution'],
+        "value": city.city_attributes['CityValue'],
+        "weather": city.city_attributes['weatherTrend'],
+        "nat_pop": city.city_attributes['NationalPop'],
+        "nat_val": city.city_attributes['NationalValue'],
+        "disaster": city.city_attributes['CurrentDisaster'],
+        "unemployment": city.city_attributes['unemployed'],
+    }
+
+
+def image_file(image_path, size: str = "full", fmt: str = "jpg") -> Path:
+    """
+    Path to one of the images made from a render.
+    Args:
+        image_path (str | Path): City.image_path, the render without a suffix.
+        size (str): one of image_sizes.
+        fmt (str): file format/extension.
+    """
+    image_path = Path(image_path)
+    return image_path.with_name(f"{image_path.name}{image_sizes[size][1]}.{fmt}")
 
-def parse_cities(p, db_session):
-    all_cities = list(p.rglob("*.sc2"))
-    failed = []
-    skipped = []
-    logger.info(f"Found {len(all_cities)} cities.")
-    # cities = {}
-    for c in all_cities:
-        city_hash = file_hash(c)
-        exists = db_session.query(City.hash).filter_by(hash=city_hash).first() is not None
-        if exists:
-            logger.warning(f"City {c} already seen with hash: {city_hash}. Skipping.")
-            skipped += [c]
-            continue
 
+def supported_formats() -> List[str]:
+    return [x for x in image_formats if x == "jpg" or f".{x}" in Image.registered_extensions()]
+
+
+def expected_images(image_path: Path) -> List[Path]:
+    """Every image file that should exist for a render."""
+    return [image_file(image_path, size, fmt) for size in image_sizes for fmt in supported_formats()]
+
+
+def save_image_sizes(img: Image.Image, image_path: Path):
+    """
+    Writes every size and format in image_sizes/image_formats for a render, skipping any that already exist.
+    Sizes are made largest first, each one scaled down from the last, so no size is resized from the full image twice.
+    Args:
+        img (Image): the render.
+        image_path (Path): render path without suffix.
+    """
+    sizes = sorted(image_sizes, key=lambda x: image_sizes[x][0] or img.size[0], reverse=True)
+    for size in sizes:
+        width = image_sizes[size][0]
+        if width is not None and width < img.size[0]:
+            height = max(1, int(img.size[1] * width / float(img.size[0])))
+            img = img.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        for fmt in supported_formats():
+            out = image_file(image_path, size, fmt)
+            if not out.exists():
+                img.save(out, **image_save_options.get(fmt, {}))
+
+
+def render_key(city_hash: str, algo: str, sprites_fp: str) -> str:
+    """
+    Content address for a city's render. Anything that would change the image goes into it.
+    Args:
+        city_hash (str): hash of the city file.
+        algo (str): algorithm city_hash was made with.
+        sprites_fp (str): RenderContext.fingerprint.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((render_version, algo, city_hash, sprites_fp, render_options)).encode())
+    return h.hexdigest()
+
+
+def render_city(city, img_path: Path, render_ctx: Optional[RenderContext] = None, tiles: bool = False, timings: Optional[dict] = None) -> Path:
+    """
+    Renders the full size image and the smaller sizes for a city.
+    Renders are cached by path (see render_key()), so if they already exist they're reused, and only missing sizes are made.
+    Args:
+        city (sc2p.City): parsed city.
+        img_path (Path): where to put the render, without suffix.
+        render_ctx (RenderContext): preloaded sprites, loaded from sprites_path if not given.
+        tiles (bool): also make a deep zoom tile pyramid, see tiles.make_pyramid().
+        timings (dict): if given, the time for each stage is added to it, see ingest_stats.stage().
+    Returns:
+        The image path, without suffix.
+    """
+    tiles = tiles and not dzi_file(img_path).exists()
+    if all(x.exists() for x in expected_images(img_path)) and not tiles:
+        logger.info(f"Using cached render {img_path}")
+        return img_path
+
+    img = None
+    if not image_file(img_path).exists():
+        logger.info(img_path)
+        if render_ctx is None:
+            render_ctx = RenderContext.load(sprites_path)
+        with render_ctx.active(), stage(timings, "render"):
+            img = cp.render_city_image(None, img_path, render_ctx.sprites_path, city, *render_options)
+
+    with stage(timings, "images"):
+        # Use the render directly if we get it back, otherwise decode the jpg.
+        if not isinstance(img, Image.Image):
+            img = Image.open(img_path.with_suffix(".jpg"))
+            widths = [x[0] for x in image_sizes.values() if x[0] is not None]
+            needs_full = tiles or (None in [x[0] for x in image_sizes.values()] and image_formats != ["jpg"])
+            if widths and not needs_full:
+                # Nothing needs the full size, so let the jpeg decoder scale down for us.
+                img.draft("RGB", (max(widths), int(img.size[1] * max(widths) / float(img.size[0]))))
+        img = img.convert("RGB")
+        save_image_sizes(img, img_path)
+    if tiles:
+        with stage(timings, "tiles"):
+            make_pyramid(img, img_path)
+    return img_path
+
+
+# State for process_city(), set up once per worker by init_worker().
+_worker = {"known": set(), "hash_algo": hash_algo, "render_ctx": None, "tiles": False}
+
+
+def init_worker(known, algo, render_ctx, tiles=False):
+    """
+    Sets up an ingest worker.
+    Args:
+        known (set[str]): hashes already in the database, so duplicates aren't parsed or rendered.
+        algo (str): hash algorithm to use.
+        render_ctx (RenderContext): preloaded sprites, shared by every city this worker renders.
+            If None they're loaded here, once per worker.
+        tiles (bool): make deep zoom tile pyramids.
+    """
+    if render_ctx is None:
+        render_ctx = RenderContext.load(sprites_path)
+    _worker["known"] = known
+    _worker["hash_algo"] = algo
+    _worker["render_ctx"] = render_ctx
+    _worker["tiles"] = tiles
+
+
+def process_city(c: Path) -> ParsedCity:
+    """
+    Reads, hashes, parses and renders a single city. The file is only read once.
+    This is run in the ingest worker processes, so it doesn't touch the database.
+    Args:
+        c (Path): path to the .sc2 file.
+    Returns:
+        ParsedCity, with error set if the city couldn't be read.
+    """
+    algo = _worker["hash_algo"]
+    timings = {}
+    with stage(timings, "read"):
+        data = read_city_file(c)
+    with stage(timings, "hash"):
+        city_hash = city_digest(data, algo)
+    if city_hash in _worker["known"]:
+        return ParsedCity(c, city_hash, algo, duplicate=True, timings=timings)
+    try:
+        with stage(timings, "parse"):
+            city = parse_city_bytes(data, c)
+    except Exception as e:
+        return ParsedCity(c, city_hash, algo, error=f"{type(e).__name__}: {e}", timings=timings)
+
+    with stage(timings, "features"):
         try:
-            city = sc2p.City()
-            city.create_city_from_file(c)
-            # cities[c] = city
+            features = city_features(city)
         except Exception as e:
-            logger.error(f"Failed reading {c}, error: {e}")
-            failed += [c]
-            continue
+            logger.warning(f"Couldn't get features for {c}: {e}")
+            features = b""
 
-        city_id = uuid.uuid4()
+    city_id = uuid.uuid4()
+    render_ctx = _worker["render_ctx"]
+    image_path = city_images / render_key(city_hash, algo, render_ctx.fingerprint)
+    try:
+        render_city(city, image_path, render_ctx, _worker["tiles"], timings)
+    except Exception as e:
+        return ParsedCity(c, city_hash, algo, error=f"{type(e).__name__}: {e}", timings=timings)
+    return ParsedCity(c, city_hash, algo, city_id, image_path, city_attributes(city), timings=timings, features=features)
 
-        img_path = city_images / Path(city_id.hex)
 
-        output_file = img_path
-        logger.info(img_path)
-        cp.render_city_image(None, output_file, sprites_path, city, False, True, False, "jpg")
-
-        # Create thumbnail version.
-        img = Image.open(img_path.with_suffix(".jpg"))
-        w_pct = thumb_width / float(img.size[0])
-        h = int(img.size[1] * w_pct)
-        img = img.resize((thumb_width, h), Image.Resampling.LANCZOS)
-        img.save(city_images / Path(f"{city_id.hex}_t").with_suffix(".jpg"))
-
-
-        name = city.city_name
-        population = city.city_attributes['TotalPop']
-        arco_pop = city.city_attributes['GlobalArcoPop']
-        start_year = city.city_attributes["baseYear"]
-        date = convert_date(start_year, city.city_attributes["simCycle"])
-        funds = city.city_attributes['TotalFunds']
-        bonds = city.city_attributes['TotalBonds']
-        game_level = city.city_attributes['GameLevel']
-        city_status = city.city_attributes['CityStatus']
-        crime = city.city_attributes['CrimeCount']
-        traffic = city.city_attributes['TrafficCount']
-        pollution = city.city_attributes['Pollution']
-        value = city.city_attributes['CityValue']
-        weather = city.city_attributes['weatherTrend']
-        nat_pop = city.city_attributes['NationalPop']
-        nat_val = city.city_attributes['NationalValue']
-        disaster = city.city_attributes['CurrentDisaster']
-        unemployment = city.city_attributes['unemployed']
-
-
-        cd = CityData(
-            id=city_id,
-            name=name,
-            population=population,
-            arco_pop=arco_pop,
-            started=start_year,
-            date=date,
-            funds=funds,
-            bonds=bonds,
-            game_level=game_level,
-            city_status=city_status,
-            crime=crime,
-            traffic=traffic,
-            pollution=pollution,
-            value=value,
-            weather=weather,
-            nat_pop=nat_pop,
-            nat_val=nat_val,
-            disaster=disaster,
-            unemployment=unemployment
-        )
-        db_session.add(cd)
+def pool_context():
+    """
+    Start method for worker pools. Fork where we can, so workers share anything the initializer gets (like the sprites)
+    copy-on-write. Forking while other threads are running (the watcher's observer, the website's workers) can copy a
+    lock one of them holds into the child, where it's never released, so then forkserver or spawn is used instead.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    if "fork" in methods and threading.active_count() == 1:
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def run_jobs(fn, jobs, workers=1, initializer=None, initargs=(), mp_context=None):
+    """
+    Runs fn over jobs, either in this process or in a pool of worker processes.
+    Args:
+        fn (callable): function to call for each job, must be picklable when workers > 1.
+        jobs (list): arguments to fn.
+        workers (int): number of worker processes, 1 runs everything in this process.
+        initializer (callable): called with initargs once per worker (or once here, with 1 worker) before any jobs.
+        initargs (tuple): arguments to initializer.
+        mp_context: multiprocessing context for the pool, pool_context() if not given.
+    Yields:
+        (job, result, exception) tuples. With workers, these come back in completion order.
+    """
+    if workers <= 1:
+        if initializer is not None and jobs:
+            initializer(*initargs)
+        for job in jobs:
+            try:
+                yield job, fn(job), None
+            except Exception as e:
+                yield job, None, e
+        return
+    ctx = mp_context or pool_context()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=initializer, initargs=initargs) as pool:
+        futures = {pool.submit(fn, job): job for job in jobs}
+        for f in as_completed(futures):
+            # Dropped as they complete, so finished results aren't all held until the end.
+            job = futures.pop(f)
+            try:
+                yield job, f.result(), None
+            except Exception as e:
+                yield job, None, e
+
+
+def load_manifest(db_session) -> Dict[str, tuple]:
+    """Returns a dictionary of path to (size, mtime_ns) for every file in the manifest."""
+    q = db_session.query(FileManifest.path, FileManifest.size, FileManifest.mtime_ns)
+    return {path: (size, mtime_ns) for path, size, mtime_ns in q}
+
+
+def update_manifest(db_session, rows: List[tuple]):
+    """
+    Records (or updates) the manifest entries for some files in one statement, rather than a merge() (a select
+    and a flush) each. Doesn't commit.
+    Args:
+        rows (list): (path, os.stat_result, city hash) for each file.
+    """
+    if not rows:
+        return
+    q = sqlite_insert(FileManifest)
+    q = q.on_conflict_do_update(
+        index_elements=["path"],
+        set_={"size": q.excluded.size, "mtime_ns": q.excluded.mtime_ns, "hash": q.excluded.hash},
+    )
+    db_session.execute(q, [{"path": str(p), "size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": h} for p, st, h in rows])
+
+
+def store_city(db_session, parsed: ParsedCity):
+    """Adds a parsed city to the session. Doesn't commit, so the City and CityData rows always go in together."""
+    cd = CityData(id=parsed.city_id, **parsed.data)
+    db_city = City(
+        id=parsed.city_id,
+        hash=parsed.city_hash,
+        hash_algo=parsed.hash_algo,
+        city_path=str(parsed.path),
+        image_path=str(parsed.image_path),
+    )
+    db_session.add_all([cd, db_city])
+    if parsed.features:
+        db_session.add(CityFeatures(id=parsed.city_id, version=feature_version, vector=parsed.features))
+
+
+def commit_batch(db_session, batch: List[ParsedCity]) -> List[Path]:
+    """
+    Commits a batch of cities in a single transaction.
+    If the commit fails, the whole batch is rolled back, so a rerun will pick those cities up again.
+    Returns:
+        List of paths that failed to commit.
+    """
+    try:
+        update_facets(db_session, [x.data for x in batch])
+        update_leaderboards(db_session, [dict(x.data, id=x.city_id) for x in batch])
+        update_fts(db_session, [{"city_id": x.city_id, "name": x.data["name"], "city_path": str(x.path), "tags": ""} for x in batch])
         db_session.commit()
+    except SQLAlchemyError as e:
+        db_session.rollback()
+        logger.error(f"Failed committing batch of {len(batch)} cities, error: {e}")
+        return [x.path for x in batch]
+    if batch:
+        logger.info(f"Committed {len(batch)} cities.")
+    return []
+
 
-        db_city = City(id=city_id, hash=city_hash, city_path=str(c), image_path=str(output_file))
-        db_session.add(db_city)
+def flush_batch(db_session, batch: List[ParsedCity], failed: List[Path]) -> List[uuid.UUID]:
+    """Commits a batch, adding anything that didn't make it to failed. Returns the ids of the cities that were added."""
+    batch_failed = commit_batch(db_session, batch)
+    failed += batch_failed
+    if batch_failed:
+        return []
+    return [x.city_id for x in batch]
 
-        db_session.commit()        
 
-    logger.info(f"Errors: {len(failed)}, skipped: {len(skipped)}.")
+def parse_cities(p, db_session, workers=1, batch_size=batch_size, algo=hash_algo, tiles=False, stats: Optional[IngestStats] = None):
+    """
+    Finds, parses and renders all the cities under p and adds them to the database.
+    Args:
+        p (Path): directory to search for .sc2 files.
+        db_session (Session): database session.
+        workers (int): number of worker processes to use.
+        batch_size (int): number of cities to insert per transaction.
+        algo (str): hash algorithm, one of hash_algos.
+        tiles (bool): also make deep zoom tile pyramids for the renders.
+        stats (IngestStats): collects timings and outcomes, see ingest_files().
+    Returns:
+        (failed, skipped, added) as returned by ingest_files().
+    """
+    all_cities = list(p.rglob("*.sc2"))
+    logger.info(f"Found {len(all_cities)} cities, using {workers} workers.")
+    return ingest_files(all_cities, db_session, workers, batch_size, algo, tiles, stats)
+
+
+def timed_flush(db_session, batch: List[ParsedCity], failed: List[Path], stats: IngestStats) -> List[uuid.UUID]:
+    """flush_batch(), with the commit timed into stats."""
+    n_failed = len(failed)
+    wall, cpu = time.perf_counter(), time.process_time()
+    added = flush_batch(db_session, batch, failed)
+    stats.add_commit(len(batch), time.perf_counter() - wall, time.process_time() - cpu, len(failed) == n_failed)
+    return added
+
+
+def ingest_files(all_cities, db_session, workers=1, batch_size=batch_size, algo=hash_algo, tiles=False, stats: Optional[IngestStats] = None):
+    """
+    Parses and renders the given city files and adds them to the database.
+    Reading, hashing, parsing and rendering are done in worker processes, this process owns the session and does the writes.
+    Duplicates are only caught against hashes made with the same algorithm, so stick to one algorithm per database.
+    Args:
+        all_cities (list[Path]): .sc2 files to ingest.
+        db_session (Session): database session.
+        workers (int): number of worker processes to use.
+        batch_size (int): number of cities to insert per transaction.
+        algo (str): hash algorithm, one of hash_algos.
+        tiles (bool): also make deep zoom tile pyramids for the renders.
+        stats (IngestStats): collects per-stage and per-file timings, outcomes and failure causes.
+            A fresh one is used if not given, either way a summary is logged at the end.
+    Returns:
+        (failed, skipped, added), where failed and skipped are lists of paths and added is a list of the new city ids.
+    """
+    failed = []
+    skipped = []
+    added = []
+    if stats is None:
+        stats = IngestStats()
+    stats.total += len(all_cities)
+
+    # Skip anything that hasn't changed since the last run without reading it.
+    manifest = load_manifest(db_session)
+    file_stats = {}
+    for c in all_cities:
+        try:
+            st = c.stat()
+        except FileNotFoundError as e:
+            # Deleted or moved since it was listed.
+            logger.warning(f"City {c} is gone, skipping.")
+            failed += [c]
+            stats.add_file(c, "failed", error=e)
+            continue
+        if manifest.get(str(c)) == (st.st_size, st.st_mtime_ns):
+            skipped += [c]
+            stats.add_file(c, "unchanged")
+            continue
+        file_stats[c] = st
+    logger.info(f"{len(skipped)} cities unchanged since last run, {len(file_stats)} to read.")
+
+    known = set(db_session.scalars(select(City.hash)))
+    batch = []
+    # Manifest entries go in with the batch they were read in, so they're rolled back with it if the commit fails.
+    manifest_rows = []
+    # Sprites are loaded once here when the workers are forked and can share them, otherwise by each worker
+    # (or this process, with one worker) in init_worker(), rather than pickled over to every one of them.
+    ctx = pool_context()
+    shared = workers > 1 and ctx.get_start_method() == "fork"
+    render_ctx = RenderContext.load(sprites_path) if file_stats and shared else None
+    jobs = run_jobs(process_city, list(file_stats), workers, init_worker, (known, algo, render_ctx, tiles), ctx)
+    for c, parsed, e in jobs:
+        if e is None and parsed.error is not None:
+            e = parsed.error
+        if e is not None:
+            logger.error(f"Failed reading {c}, error: {e}")
+            failed += [c]
+            stats.add_file(c, "failed", None if parsed is None else parsed.timings, e)
+            continue
+        # Two copies of a new city in the same run are both rendered, since the workers can't see each other's hashes.
+        if parsed.duplicate or parsed.city_hash in known:
+            logger.warning(f"City {c} already seen with hash: {parsed.city_hash}. Skipping.")
+            skipped += [c]
+            manifest_rows += [(c, file_stats[c], parsed.city_hash)]
+            stats.add_file(c, "duplicate", parsed.timings)
+            continue
+        known.add(parsed.city_hash)
+        store_city(db_session, parsed)
+        manifest_rows += [(c, file_stats[c], parsed.city_hash)]
+        stats.add_file(c, "added", parsed.timings)
+        batch += [parsed]
+        if len(batch) >= batch_size:
+            update_manifest(db_session, manifest_rows)
+            added += timed_flush(db_session, batch, failed, stats)
+            batch = []
+            manifest_rows = []
+    update_manifest(db_session, manifest_rows)
+    added += timed_flush(db_session, batch, failed, stats)
+
+    logger.info(f"Added: {len(added)}, errors: {len(failed)}, skipped: {len(skipped)}.")
+    stats.finish()
+    return failed, skipped, added
 
 def check_db_images(db_session):
-    """Checks to make sure that the database and images are good."""
-    a = [x.id.hex for x in db_session.query(CityData).all()]
-    b = [x.id.hex for x in db_session.query(CityData).all()]
-    c = [x.stem for x in city_images.iterdir() if x.is_file()]
-    logger.info([len(a), len(b), len(c)])
+    """
+    Checks to make sure that the database and images are good.
+    Renders are shared by identical cities and saved in several sizes and formats, so this counts the distinct
+    full size renders the cities point at, and how many of those are missing.
+    """
+    cities = db_session.scalar(select(func.count()).select_from(CityData))
+    renders = {image_file(x, "full", "jpg") for x in db_session.scalars(select(City.image_path).distinct())}
+    missing = [x for x in renders if not x.is_file()]
+    logger.info(f"{cities} cities, {len(renders)} distinct renders, {len(missing)} missing.")
+    for x in missing[:10]:
+        logger.warning(f"Missing render: {x}")
 
 
 
 def create_session(p=None):
     if p is None:
         p = Path(db_dir) / db_fn
-    engine = create_engine(f"sqlite:///{p}", echo=False)
+    engine = sqlite_engine(p)
     db_session = Session(engine)
     return db_session
 
 
+def session_factory(p=None, pool_size: int = pool_size) -> sessionmaker:
+    """
+    Makes short lived sessions on a pooled engine that can be shared between threads, for the website.
+    Each request or UI handler should use its own session (with sessions() as s: ...), not one shared global one.
+    Objects aren't expired on commit, so they can still be read after their session is closed.
+    Args:
+        p (Path): database file.
+        pool_size (int): connections kept open. In WAL mode SQLite readers don't block each other, so this is
+            roughly how many queries can run at once.
+    """
+    if p is None:
+        p = Path(db_dir) / db_fn
+    engine = sqlite_engine(p, pool_size=pool_size, max_overflow=pool_size, connect_args={"check_same_thread": False})
+    return sessionmaker(engine, expire_on_commit=False)
+
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parse and render cities into the database.")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes.")
+    parser.add_argument("-b", "--batch-size", type=int, default=batch_size, help="Number of cities per commit.")
+    parser.add_argument("--hash", choices=sorted(hash_algos), default=hash_algo, help="Hash algorithm for new cities.")
+    parser.add_argument("--tiles", action="store_true", help="Also make deep zoom tile pyramids for the renders.")
+    parser.add_argument("--report", type=Path, default=Path(db_dir) / "ingest_report", help="Where to write the timing report, as .json and .csv.")
+    args = parser.parse_args()
+
     p = Path(db_dir) / db_fn
     create_db(p)
     db_session = create_session(p)
-    parse_cities(cities_dir, db_session)
+    stats = IngestStats(status_file)
+    parse_cities(cities_dir, db_session, args.workers, args.batch_size, args.hash, args.tiles, stats)
+    stats.write_report(args.report)
+    # Imported here since snapshot imports this module.
+    from snapshot import update_snapshot
+    update_snapshot(db_session)
     check_db_images(db_session)
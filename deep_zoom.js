@@ -0,0 +1,42 @@
+// The browser side of views.DeepZoom: an OpenSeadragon viewer, started once its element is mounted.
+// OpenSeadragon itself is only loaded the first time a viewer is shown, so pages without one never fetch it.
+let loading = null;
+
+function loadOpenSeadragon(url) {
+  if (loading === null) {
+    loading = new Promise((resolve, reject) => {
+      const script = document.createElement("script");
+      script.src = url;
+      script.onload = resolve;
+      script.onerror = () => {
+        loading = null;
+        reject(new Error(`Couldn't load ${url}`));
+      };
+      document.head.appendChild(script);
+    });
+  }
+  return loading;
+}
+
+export default {
+  template: "<div></div>",
+  props: {
+    tileSources: String,
+    prefixUrl: String,
+  },
+  async mounted() {
+    await loadOpenSeadragon(this.prefixUrl + "openseadragon.min.js");
+    // Closed while the script was loading.
+    if (this.closed) return;
+    this.viewer = OpenSeadragon({
+      element: this.$el,
+      prefixUrl: this.prefixUrl + "images/",
+      tileSources: this.tileSources,
+      showNavigator: true,
+    });
+  },
+  unmounted() {
+    this.closed = true;
+    if (this.viewer) this.viewer.destroy();
+  },
+};
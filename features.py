@@ -0,0 +1,113 @@
+from typing import List
+
+import numpy as np
+
+# Bump when the feature layout changes, so stored vectors can be found and remade.
+feature_version = 2
+# Bins for each histogram. Zones and terrain have fewer than 16 values, building ids go up to 255 and are bucketed.
+zone_bins = 16
+terrain_bins = 16
+building_bins = 32
+# Building ids of the road pieces (straights, corners, tees, the crossroads and slopes), each gets its own bin.
+road_ids = range(0x1D, 0x2C)
+# Attributes of the parsed city and its tiles that the features are made from.
+tiles_attr = "tilelist"
+tile_fields = ("zone", "terrain", "building")
+# Side of the downsampled grids, each cell covers (map size / grid_size)^2 tiles.
+grid_size = 8
+# Sections of the vector, in order, and their lengths.
+sections = {
+    "zones": zone_bins,
+    "terrain": terrain_bins,
+    "buildings": building_bins,
+    "roads": len(road_ids),
+    "developed": grid_size * grid_size,
+    "built": grid_size * grid_size,
+}
+feature_length = sum(sections.values())
+
+
+def city_tiles(city) -> List[tuple]:
+    """
+    The map tiles of a parsed city as (x, y, tile), from city.tilelist, which is keyed by (x, y).
+    Raises:
+        ValueError: if the city doesn't have tiles laid out like that, so it's clear the parser has changed
+            rather than every city quietly getting the same vector.
+    Returns:
+        List of tiles, empty if the city has none.
+    """
+    tiles = getattr(city, tiles_attr, None)
+    if tiles is None:
+        raise ValueError(f"Parsed city has no {tiles_attr}, can't make features.")
+    if not tiles:
+        return []
+    if not isinstance(tiles, dict) or not all(isinstance(k, tuple) and len(k) == 2 for k in tiles):
+        raise ValueError(f"Expected {tiles_attr} to be a dict keyed by (x, y), got {type(tiles).__name__}.")
+    return [(k[0], k[1], v) for k, v in tiles.items()]
+
+
+def tile_values(tiles: List[tuple], name: str) -> np.ndarray:
+    """
+    One of tile_fields for every tile, as ints.
+    Raises:
+        ValueError: if the tiles don't have it, or it isn't a number.
+    """
+    missing = sum(1 for _, _, t in tiles if not hasattr(t, name))
+    if missing:
+        raise ValueError(f"{missing} of {len(tiles)} tiles have no {name}, can't make features.")
+    try:
+        return np.fromiter((int(getattr(t, name)) for _, _, t in tiles), dtype=np.int64, count=len(tiles))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Tile {name} isn't a number: {e}") from e
+
+
+def _histogram(values: np.ndarray, bins: int, width: int = 1) -> np.ndarray:
+    counts = np.bincount(np.clip(values // width, 0, bins - 1), minlength=bins)
+    total = counts.sum()
+    return counts / total if total else counts.astype(float)
+
+
+def _grid(xs: np.ndarray, ys: np.ndarray, flags: np.ndarray, side: int) -> np.ndarray:
+    """Fraction of the tiles in each grid cell that have the flag set."""
+    cx = np.minimum(xs * grid_size // side, grid_size - 1)
+    cy = np.minimum(ys * grid_size // side, grid_size - 1)
+    cells = cy * grid_size + cx
+    hits = np.bincount(cells, weights=flags, minlength=grid_size * grid_size)
+    totals = np.bincount(cells, minlength=grid_size * grid_size)
+    return np.divide(hits, totals, out=np.zeros(grid_size * grid_size), where=totals > 0)
+
+
+def city_features(city) -> bytes:
+    """
+    Packs the layout of a city into a fixed length vector, for finding cities that look alike:
+    normalized histograms of zones, terrain and buildings (buildings bucketed 8 ids to a bin, which roughly groups
+    roads, rails, power lines and each kind of building), of the road pieces (a grid has lots of crossroads, a
+    winding layout lots of corners), and grid_size x grid_size maps of the fraction of each area that is zoned
+    and that has something built on it.
+    Each value is quantized to a byte, so a vector is feature_length bytes.
+    Raises:
+        ValueError: if the tiles can't be read, see city_tiles() and tile_values().
+    Returns:
+        The packed vector, empty if the city has no tiles.
+    """
+    tiles = city_tiles(city)
+    if not tiles:
+        return b""
+    xs = np.fromiter((x for x, _, _ in tiles), dtype=np.int64, count=len(tiles))
+    ys = np.fromiter((y for _, y, _ in tiles), dtype=np.int64, count=len(tiles))
+    zones, terrain, buildings = (tile_values(tiles, x) for x in tile_fields)
+    roads = buildings[(buildings >= road_ids.start) & (buildings < road_ids.stop)] - road_ids.start
+    side = int(max(xs.max(), ys.max())) + 1
+    vector = np.concatenate([
+        _histogram(zones, zone_bins),
+        _histogram(terrain, terrain_bins),
+        _histogram(buildings, building_bins, 256 // building_bins),
+        _histogram(roads, len(road_ids)),
+        _grid(xs, ys, (zones > 0).astype(float), side),
+        _grid(xs, ys, (buildings > 0).astype(float), side),
+    ])
+    return np.round(np.clip(vector, 0, 1) * 255).astype(np.uint8).tobytes()
+
+
+def unpack(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.uint8)
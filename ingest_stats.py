@@ -0,0 +1,186 @@
+from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+from collections import Counter
+from contextlib import contextmanager
+from attrs import define, field, Factory
+from loguru import logger
+import csv
+import heapq
+import json
+import os
+import time
+
+# Ingest stages, in the order they happen. Everything but commit is timed per file in the workers.
+stages = ["read", "hash", "parse", "features", "render", "images", "tiles", "commit"]
+# Where a running ingest publishes its counters for the website's admin page.
+status_file = Path("db") / "ingest_status.json"
+# Seconds between status file updates.
+status_interval = 1.0
+
+
+@contextmanager
+def stage(timings: Optional[Dict[str, Tuple[float, float]]], name: str):
+    """
+    Adds the wall and CPU time of the block to timings[name], as (wall, cpu) seconds. Does nothing if timings is None.
+    CPU time is this process's, so it's right in the worker processes too.
+    """
+    if timings is None:
+        yield
+        return
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        old_wall, old_cpu = timings.get(name, (0.0, 0.0))
+        timings[name] = (old_wall + time.perf_counter() - wall, old_cpu + time.process_time() - cpu)
+
+
+def failure_cause(error) -> str:
+    """Groups failures by exception type, so the report shows what's going wrong and not every message."""
+    if isinstance(error, BaseException):
+        return type(error).__name__
+    return str(error).split(":", 1)[0].strip() or "unknown"
+
+
+@define
+class IngestStats:
+    """
+    Timing and outcome counters for one ingest run.
+    Per-file stage times come back from the workers with each ParsedCity, commits are timed here per batch.
+    Args:
+        status_path (Path): if given, snapshot() is written here every status_interval seconds while the run goes,
+            for the website's admin page.
+        slowest_n (int): how many of the slowest files to keep.
+    """
+    status_path: Optional[Path] = None
+    slowest_n: int = 20
+    total: int = 0
+    outcomes: Counter = field(default=Factory(Counter))
+    # Stage name to [wall, cpu, count].
+    stage_totals: Dict[str, List[float]] = field(default=Factory(lambda: {x: [0.0, 0.0, 0] for x in stages}))
+    failures: Counter = field(default=Factory(Counter))
+    # (path, outcome, error, timings) for every file, for the CSV.
+    files: List[tuple] = field(default=Factory(list))
+    started: float = field(default=Factory(time.time))
+    finished: Optional[float] = None
+    _slowest: List[tuple] = field(init=False, default=Factory(list))
+    _last_write: float = field(init=False, default=0.0)
+
+    def add_file(self, path: Path, outcome: str, timings: Optional[Dict[str, Tuple[float, float]]] = None, error=None):
+        """
+        Records one file.
+        Args:
+            path (Path): the city file.
+            outcome (str): added, duplicate, unchanged or failed.
+            timings (dict): stage name to (wall, cpu) seconds.
+            error: exception or error message, for failed files.
+        """
+        timings = timings or {}
+        self.outcomes[outcome] += 1
+        for name, (wall, cpu) in timings.items():
+            totals = self.stage_totals.setdefault(name, [0.0, 0.0, 0])
+            totals[0] += wall
+            totals[1] += cpu
+            totals[2] += 1
+        cause = None
+        if outcome == "failed":
+            cause = failure_cause(error)
+            self.failures[cause] += 1
+        self.files += [(str(path), outcome, "" if error is None else str(error), timings)]
+        wall = sum(x[0] for x in timings.values())
+        if wall > 0:
+            item = (wall, str(path), timings)
+            if len(self._slowest) < self.slowest_n:
+                heapq.heappush(self._slowest, item)
+            elif wall > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, item)
+        self._maybe_write()
+
+    def add_commit(self, n: int, wall: float, cpu: float, ok: bool = True):
+        """Records a batch commit of n cities. If it failed, they're already counted as added, so move them to failed."""
+        totals = self.stage_totals["commit"]
+        totals[0] += wall
+        totals[1] += cpu
+        totals[2] += 1
+        if not ok:
+            self.outcomes["added"] -= n
+            self.outcomes["failed"] += n
+            self.failures["commit"] += n
+        self._maybe_write()
+
+    def done(self) -> int:
+        return sum(self.outcomes.values())
+
+    def slowest(self) -> List[tuple]:
+        """(wall seconds, path, timings) for the slowest files, slowest first."""
+        return sorted(self._slowest, reverse=True)
+
+    def snapshot(self) -> dict:
+        end = self.finished or time.time()
+        elapsed = end - self.started
+        return {
+            "running": self.finished is None,
+            "started": self.started,
+            "elapsed_s": elapsed,
+            "total": self.total,
+            "done": self.done(),
+            "outcomes": dict(self.outcomes),
+            "rate_per_s": self.done() / elapsed if elapsed > 0 else 0.0,
+            "stages": {
+                k: {"wall_s": w, "cpu_s": c, "count": n, "mean_ms": w / n * 1000 if n else 0.0}
+                for k, (w, c, n) in self.stage_totals.items()
+            },
+            "slowest": [{"path": p, "wall_s": w, "stages": {k: v[0] for k, v in t.items()}} for w, p, t in self.slowest()],
+            "failures": dict(self.failures.most_common()),
+        }
+
+    def _maybe_write(self, force: bool = False):
+        if self.status_path is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_write < status_interval:
+            return
+        self._last_write = now
+        write_json(self.status_path, self.snapshot())
+
+    def finish(self):
+        """Marks the run as done, writes the final status and logs a summary."""
+        self.finished = time.time()
+        self._maybe_write(force=True)
+        snap = self.snapshot()
+        busy = sorted(snap["stages"].items(), key=lambda x: x[1]["wall_s"], reverse=True)
+        logger.info(f"Ingested {snap['done']} files in {snap['elapsed_s']:.1f}s, {snap['outcomes']}.")
+        logger.info("Stage wall time: " + ", ".join(f"{k} {v['wall_s']:.1f}s" for k, v in busy if v["count"]))
+        if self.failures:
+            logger.info(f"Failure causes: {dict(self.failures.most_common())}")
+
+    def write_report(self, path: Path):
+        """Writes the summary to path with a .json suffix, and every file's stage times to the same path with .csv."""
+        path = Path(path)
+        write_json(path.with_suffix(".json"), self.snapshot())
+        with open(path.with_suffix(".csv"), "w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["path", "outcome", "error", "wall_s"] + [f"{x}_{y}_s" for x in stages[:-1] for y in ("wall", "cpu")])
+            for p, outcome, error, timings in self.files:
+                row = [p, outcome, error, f"{sum(x[0] for x in timings.values()):.6f}"]
+                for name in stages[:-1]:
+                    row += [f"{x:.6f}" for x in timings.get(name, (0.0, 0.0))]
+                w.writerow(row)
+        logger.info(f"Wrote ingest report to {path.with_suffix('.json')} and {path.with_suffix('.csv')}")
+
+
+def write_json(path: Path, data: dict):
+    """Writes atomically, so a reader never sees half a file."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_text(json.dumps(data, indent=2))
+    os.replace(tmp, path)
+
+
+def read_status(path: Path = status_file) -> Optional[dict]:
+    """The last status written by an ingest, or None if there isn't one."""
+    try:
+        return json.loads(Path(path).read_text())
+    except (OSError, ValueError):
+        return None
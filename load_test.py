@@ -0,0 +1,137 @@
+from typing import Callable, List
+from pathlib import Path
+from random import Random
+from statistics import median, quantiles
+from loguru import logger
+import argparse
+import asyncio
+import json
+import time
+
+from opencity2k.Data.value_mappings import disaster_type
+
+from db import create_session, session_factory, db_dir, db_fn, pool_size
+from search import CityQuery, count_cities, search_cities, facet_counts, name_search
+
+# How often the heartbeat checks the event loop is still responsive, in seconds.
+tick = 0.005
+# Prefixes for the name search part of an interaction, like someone typing into the search box.
+name_prefixes = ["new", "san", "city", "river", "port", "lake", "north", "a", "the", "m"]
+
+
+def interaction(db_session, query: CityQuery, name: str):
+    """The queries behind one search in the UI: the count, the first page, the facet counts and the autocomplete."""
+    count_cities(db_session, query)
+    search_cities(db_session, query, 0, 48, count=False)
+    facet_counts(db_session, query)
+    name_search(db_session, name)
+
+
+def make_queries(n: int, seed: int) -> List[tuple]:
+    rng = Random(seed)
+    queries = []
+    for _ in range(n):
+        equals = {"disaster": rng.choice(list(disaster_type))} if rng.random() < 0.5 else {}
+        ranges = {"total_pop": (rng.choice([0, 1000, 10000, 100000]), None)}
+        queries += [(CityQuery(equals, ranges), rng.choice(name_prefixes))]
+    return queries
+
+
+async def heartbeat(stop: asyncio.Event) -> float:
+    """Longest the event loop went without running this, in seconds. Ideally about tick."""
+    worst = 0.0
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(tick)
+        now = time.perf_counter()
+        worst = max(worst, now - last - tick)
+        last = now
+    return worst
+
+
+async def run_users(call: Callable, queries: List[tuple]) -> dict:
+    """Runs every user's interaction at once, and times them and the event loop."""
+    stop = asyncio.Event()
+    beat = asyncio.create_task(heartbeat(stop))
+    latencies = []
+
+    async def user(query, name):
+        start = time.perf_counter()
+        await call(query, name)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user(q, n) for q, n in queries))
+    wall = time.perf_counter() - start
+    stop.set()
+    stall = await beat
+    p = quantiles(latencies, n=20) if len(latencies) > 1 else latencies * 19
+    return {
+        "users": len(queries),
+        "wall_s": wall,
+        "latency_p50_s": median(latencies),
+        "latency_p95_s": p[18],
+        "latency_max_s": max(latencies),
+        "max_loop_stall_s": stall,
+    }
+
+
+async def blocking(p: Path, queries: List[tuple]) -> dict:
+    """The old way: one shared session, and queries run right on the event loop."""
+    db_session = create_session(p)
+
+    async def call(query, name):
+        interaction(db_session, query, name)
+
+    try:
+        return await run_users(call, queries)
+    finally:
+        db_session.close()
+
+
+async def threaded(p: Path, queries: List[tuple], pool_size: int) -> dict:
+    """
+    The website's way: a session per call from a pool, run in a worker thread.
+    This is what website.run_db() does, with asyncio.to_thread standing in for nicegui's run.io_bound.
+    """
+    sessions = session_factory(p, pool_size)
+
+    def work(query, name):
+        with sessions() as db_session:
+            interaction(db_session, query, name)
+
+    async def call(query, name):
+        await asyncio.to_thread(work, query, name)
+
+    return await run_users(call, queries)
+
+
+async def main(p: Path, users: int, pool_size: int, seed: int) -> dict:
+    queries = make_queries(users, seed)
+    # Once on its own, to warm SQLite's page cache and get the time for one user with nothing else going on.
+    single = await threaded(p, queries[:1], pool_size)
+    results = {"single": single}
+    for name, fn in (("blocking", lambda: blocking(p, queries)), ("threaded", lambda: threaded(p, queries, pool_size))):
+        res = await fn()
+        # 1 means users waited for each other as if they'd been served one at a time, lower is better.
+        res["serialization"] = res["wall_s"] / (single["wall_s"] * users)
+        results[name] = res
+        logger.info(
+            f"{name}: {users} users in {res['wall_s']:.3f}s, p95 {res['latency_p95_s'] * 1000:.1f}ms, "
+            f"event loop stalled up to {res['max_loop_stall_s'] * 1000:.1f}ms, serialization {res['serialization']:.2f}."
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulates concurrent website users searching, to check they don't queue behind each other.")
+    parser.add_argument("-u", "--users", type=int, default=32, help="Number of users searching at once.")
+    parser.add_argument("-p", "--pool-size", type=int, default=pool_size, help="Connections in the pool for the threaded run.")
+    parser.add_argument("--db", type=Path, default=Path(db_dir) / db_fn, help="Database to run against.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the random searches.")
+    parser.add_argument("--json", type=Path, help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    results = asyncio.run(main(args.db, args.users, args.pool_size, args.seed))
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=2))
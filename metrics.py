@@ -0,0 +1,256 @@
+from typing import Callable, Dict, List, Optional, Tuple
+from bisect import bisect_left
+from collections import Counter
+from contextvars import ContextVar, copy_context
+from threading import Lock, Thread, Event, get_ident
+from attrs import define, field, Factory
+from loguru import logger
+import functools
+import inspect
+import os
+import sys
+import time
+
+from sqlalchemy import event
+
+# Upper bounds in seconds for the latency histograms, Prometheus' defaults.
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds for the counts per interaction, queries and UI elements.
+count_buckets = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# The sampling profiler is off unless this is set, it costs a little on every sample even when idle.
+profiler_enabled = os.environ.get("SC2K_PROFILER") == "1"
+# Seconds between profiler samples.
+profile_interval = 0.005
+
+
+@define
+class Histogram:
+    """Cumulative histogram in the Prometheus sense. Safe to observe from any thread."""
+    buckets: Tuple[float, ...]
+    counts: List[int] = field(init=False)
+    total: float = 0.0
+    n: int = 0
+    _lock: Lock = field(init=False, default=Factory(Lock))
+
+    def __attrs_post_init__(self):
+        self.counts = [0] * len(self.buckets)
+
+    def observe(self, value: float):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            if i < len(self.counts):
+                self.counts[i] += 1
+            self.total += value
+            self.n += 1
+
+
+@define
+class Metrics:
+    """Every metric, keyed by name and label values. Metric names and help text are registered up front."""
+    help: Dict[str, Tuple[str, str]] = field(default=Factory(dict))
+    histograms: Dict[Tuple[str, tuple], Histogram] = field(default=Factory(dict))
+    counters: Dict[Tuple[str, tuple], float] = field(default=Factory(dict))
+    _lock: Lock = field(init=False, default=Factory(Lock))
+
+    def register(self, name: str, kind: str, text: str):
+        self.help[name] = (kind, text)
+
+    def observe(self, name: str, value: float, buckets=latency_buckets, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        h = self.histograms.get(key)
+        if h is None:
+            with self._lock:
+                h = self.histograms.setdefault(key, Histogram(buckets))
+        h.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self) -> str:
+        """Everything in the Prometheus text exposition format."""
+        lines = []
+        by_name = {}
+        for (name, labels), h in sorted(self.histograms.items()):
+            by_name.setdefault(name, []).append((labels, h))
+        for (name, labels), v in sorted(self.counters.items()):
+            by_name.setdefault(name, []).append((labels, v))
+        for name, series in by_name.items():
+            kind, text = self.help.get(name, ("untyped", ""))
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+            for labels, value in series:
+                if isinstance(value, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(value.buckets, value.counts):
+                        cumulative += count
+                        lines += [f"{name}_bucket{_labels(labels, le=_num(bound))} {cumulative}"]
+                    lines += [f"{name}_bucket{_labels(labels, le='+Inf')} {value.n}"]
+                    lines += [f"{name}_sum{_labels(labels)} {value.total}", f"{name}_count{_labels(labels)} {value.n}"]
+                else:
+                    lines += [f"{name}{_labels(labels)} {_num(value)}"]
+        return "\n".join(lines) + "\n"
+
+
+def _num(x) -> str:
+    return str(int(x)) if float(x).is_integer() else repr(float(x))
+
+
+def _labels(labels: tuple, **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in items]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+metrics = Metrics()
+metrics.register("ui_handler_seconds", "histogram", "Time taken by UI event handlers, including any awaited DB work.")
+metrics.register("ui_handler_queries", "histogram", "DB queries run per UI interaction.")
+metrics.register("ui_handler_elements", "histogram", "UI elements built per UI interaction.")
+metrics.register("ui_handler_errors_total", "counter", "UI event handlers that raised.")
+metrics.register("db_query_seconds", "histogram", "Time taken by DB queries, by statement type.")
+metrics.register("db_queries_total", "counter", "DB queries run, by statement type.")
+
+
+@define
+class Interaction:
+    """What one UI interaction has done so far. Shared with any worker threads it starts, see in_context()."""
+    handler: str
+    queries: int = 0
+
+
+# The interaction the current code is running for, if any.
+current: ContextVar[Optional[Interaction]] = ContextVar("current_interaction", default=None)
+
+
+def in_context(fn: Callable) -> Callable:
+    """
+    Wraps fn to run in a copy of the current context, so queries it runs in a worker thread count toward
+    the interaction that started it. nicegui's run.io_bound uses run_in_executor, which doesn't copy the context.
+    """
+    ctx = copy_context()
+    return functools.wraps(fn)(lambda *args, **kwargs: ctx.run(fn, *args, **kwargs))
+
+
+def _element_count() -> Optional[int]:
+    """Number of elements made so far for the current client, or None outside of a UI context."""
+    try:
+        from nicegui import context
+        client = context.client
+    except (ImportError, RuntimeError):
+        return None
+    next_id = getattr(client, "next_element_id", None)
+    return next_id if next_id is not None else len(client.elements)
+
+
+def instrumented(name: str):
+    """
+    Decorator for UI event handlers, sync or async. Records the handler's latency and, for the outermost handler
+    of an interaction, how many queries it ran and how many UI elements it built.
+    """
+    def decorator(fn):
+        def start():
+            outer = current.get() is None
+            token = current.set(Interaction(name)) if outer else None
+            return outer, token, _element_count(), time.perf_counter()
+
+        def end(outer, token, elements, t, failed):
+            metrics.observe("ui_handler_seconds", time.perf_counter() - t, handler=name)
+            if failed:
+                metrics.inc("ui_handler_errors_total", handler=name)
+            if outer:
+                interaction = current.get()
+                current.reset(token)
+                metrics.observe("ui_handler_queries", interaction.queries, count_buckets, handler=name)
+                after = _element_count()
+                if elements is not None and after is not None:
+                    metrics.observe("ui_handler_elements", max(0, after - elements), count_buckets, handler=name)
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                state = start()
+                failed = True
+                try:
+                    result = await fn(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    end(*state, failed)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                state = start()
+                failed = True
+                try:
+                    result = fn(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    end(*state, failed)
+        return wrapper
+    return decorator
+
+
+def instrument_engine(engine):
+    """Times every query on engine, and counts it toward the current interaction."""
+
+    # The start time goes on the execution context, which is per statement, so a query that fails (and never
+    # gets an after_cursor_execute) doesn't leave anything behind on the pooled connection.
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_query_start", None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        metrics.observe("db_query_seconds", elapsed, kind=kind)
+        metrics.inc("db_queries_total", kind=kind)
+        interaction = current.get()
+        if interaction is not None:
+            interaction.queries += 1
+
+
+@define
+class SamplingProfiler:
+    """
+    Samples the stack of one thread every profile_interval seconds from a background thread.
+    Results are folded stacks ("module:function;module:function count" per line), which flamegraph.pl and
+    speedscope both read. Nothing in the profiled thread is hooked, so it's cheap enough to run in production.
+    """
+    thread_id: int = field(factory=get_ident)
+    samples: Counter = field(init=False, default=Factory(Counter))
+    _stop: Event = field(init=False, default=Factory(Event))
+    _thread: Optional[Thread] = field(init=False, default=None)
+
+    def _run(self):
+        while not self._stop.wait(profile_interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._stop.clear()
+        self.samples.clear()
+        self._thread = Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"Profiling thread {self.thread_id}.")
+
+    def stop(self) -> str:
+        """Stops sampling and returns the folded stacks, most common first."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return "\n".join(f"{stack} {n}" for stack, n in self.samples.most_common()) + "\n"
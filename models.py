@@ -2,6 +2,8 @@ from attrs import define, Factory, field
 from uuid import UUID
 from db import City as DbCity
 from db import CityData as DbCityData
+from db import image_file
+from tiles import dzi_file
 from pathlib import Path
 
 
@@ -22,8 +24,30 @@ class CityModel:
     
     @property
     def city_image(self):
-        return self.city_images / f"{self.city_id.hex}.jpg"
+        return image_file(self.image_path, "full")
     
     @property
     def city_thumb_image(self):
-        return self.city_images / f"{self.city_id.hex}_t.jpg"
\ No newline at end of file
+        return image_file(self.image_path, "gallery")
+
+    def image(self, size: str = "full", fmt: str = "jpg") -> Path:
+        """One of the sizes/formats made at ingest, falling back to the jpg if it wasn't made for this city."""
+        p = image_file(self.image_path, size, fmt)
+        if fmt != "jpg" and not p.exists():
+            return image_file(self.image_path, size, "jpg")
+        return p
+
+    def image_url(self, size: str = "full", fmt: str = "jpg") -> str:
+        """URL for image(), served with long lived caching, since render names are content hashes."""
+        return f"/img/{self.image(size, fmt).name}"
+
+    @property
+    def download_url(self) -> str:
+        return f"/download/{self.db_city.hash}"
+
+    @property
+    def dzi_url(self):
+        """URL of the deep zoom descriptor, or None if no tile pyramid was made for this city."""
+        if not dzi_file(self.image_path).exists():
+            return None
+        return f"/tiles/{Path(self.image_path).name}.dzi"
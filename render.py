@@ -0,0 +1,88 @@
+from typing import Dict
+from pathlib import Path
+from contextlib import contextmanager
+from attrs import define, field, Factory
+from loguru import logger
+from PIL import Image
+import hashlib
+import importlib.metadata
+import io
+import os
+
+
+@define
+class RenderContext:
+    """
+    The sprite set, read and decoded once and reused for every render.
+    Build it in the main process before forking the ingest workers, so they share the decoded sprites copy-on-write
+    instead of each loading their own. Otherwise each worker loads it once, rather than decoding the sprites again
+    for every city.
+    """
+    sprites_path: Path
+    fingerprint: str = ""
+    atlas: Dict[str, Image.Image] = field(default=Factory(dict))
+    # Sprite opens served from the atlas, and ones that fell through to disk, during the last active() block.
+    hits: int = field(init=False, default=0)
+    misses: int = field(init=False, default=0)
+
+    @classmethod
+    def load(cls, sprites_path: Path):
+        """
+        Reads every file in the sprites directory, decoding the images into the atlas.
+        The same bytes are hashed along with the renderer version into fingerprint, for the render cache.
+        """
+        h = hashlib.blake2b(digest_size=16)
+        atlas = {}
+        for p in sorted(sprites_path.rglob("*")):
+            if not p.is_file():
+                continue
+            data = p.read_bytes()
+            h.update(str(p.relative_to(sprites_path)).encode())
+            h.update(data)
+            try:
+                img = Image.open(io.BytesIO(data))
+                img.load()
+            except (OSError, SyntaxError):
+                # Not an image, the renderer can still read it from disk.
+                continue
+            atlas[cls._key(p)] = img
+        try:
+            h.update(importlib.metadata.version("opencity2k").encode())
+        except importlib.metadata.PackageNotFoundError:
+            pass
+        logger.info(f"Loaded {len(atlas)} sprites from {sprites_path}.")
+        return cls(sprites_path, h.hexdigest(), atlas)
+
+    @staticmethod
+    def _key(fp) -> str:
+        return os.path.abspath(os.fspath(fp))
+
+    @contextmanager
+    def active(self):
+        """
+        While active, the renderer's Image.open() calls for sprite files get a copy of the decoded sprite from the atlas.
+        Copying is a memcpy, where opening the file again means reading and decoding it.
+        Hits and misses are counted and logged at the end, misses mean the renderer is opening sprites by some
+        path the atlas doesn't know about and is reading them from disk again.
+        """
+        original = Image.open
+        self.hits = self.misses = 0
+
+        def open_sprite(fp, *args, **kwargs):
+            if isinstance(fp, (str, os.PathLike)):
+                img = self.atlas.get(self._key(fp))
+                if img is not None:
+                    self.hits += 1
+                    return img.copy()
+                self.misses += 1
+            return original(fp, *args, **kwargs)
+
+        Image.open = open_sprite
+        try:
+            yield self
+        finally:
+            Image.open = original
+            if self.misses and not self.hits:
+                logger.warning(f"Sprite atlas wasn't used, {self.misses} sprites were read from disk.")
+            else:
+                logger.debug(f"Sprite atlas: {self.hits} hits, {self.misses} misses.")
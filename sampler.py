@@ -0,0 +1,63 @@
+from typing import Dict, Optional, Tuple
+from array import array
+from bisect import bisect_left
+from random import randrange
+from attrs import define, field, Factory
+import uuid
+
+from city_index import CityIndex
+
+# Fields that can be used to filter random picks by value.
+sample_facets = ["disaster", "weather"]
+
+
+def _by_pop(index: CityIndex, ordinals) -> Tuple[array, array]:
+    """Ordinals sorted by total population, and the matching populations."""
+    pop = index.column("total_pop")
+    ordinals = sorted(ordinals, key=pop.__getitem__)
+    return array("i", ordinals), array("q", (pop[x] for x in ordinals))
+
+
+@define
+class CitySampler:
+    """
+    Uniform random cities from a CityIndex.
+    A plain pick is a single randrange() over the dense ordinals. For filtered picks, the ordinals for every facet
+    value are precomputed and sorted by total population, so a pick is a randrange() over that group, with a
+    bisect to find where a population threshold starts. Neither depends on scanning the catalog.
+    """
+    index: CityIndex
+    _all: Tuple[array, array] = field(init=False, default=None)
+    _groups: Dict[Tuple[str, int], Tuple[array, array]] = field(init=False, default=Factory(dict))
+
+    def __attrs_post_init__(self):
+        self.rebuild()
+
+    def rebuild(self):
+        """Recomputes the groups, after the index has had new cities added."""
+        self._all = _by_pop(self.index, range(len(self.index)))
+        members = {}
+        for facet in sample_facets:
+            for ordinal, value in enumerate(self.index.column(facet)):
+                members.setdefault((facet, value), []).append(ordinal)
+        self._groups = {k: _by_pop(self.index, v) for k, v in members.items()}
+
+    def random(self, facet: Optional[str] = None, value: Optional[int] = None, min_pop: Optional[int] = None) -> Optional[uuid.UUID]:
+        """
+        Picks a random city.
+        Args:
+            facet (str): optionally, only pick cities where this field (one of sample_facets)...
+            value (int): ...has this value.
+            min_pop (int): optionally, only pick cities with at least this total population.
+        Returns:
+            The city's id, or None if no city matches.
+        """
+        if len(self.index) == 0:
+            return None
+        if facet is None and min_pop is None:
+            return self.index.city_id(randrange(len(self.index)))
+        ordinals, pops = self._all if facet is None else self._groups.get((facet, int(value)), (array("i"), array("q")))
+        start = 0 if min_pop is None else bisect_left(pops, min_pop)
+        if start >= len(ordinals):
+            return None
+        return self.index.city_id(ordinals[randrange(start, len(ordinals))])
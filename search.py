@@ -0,0 +1,167 @@
+from typing import Dict, Any, List, Tuple, Optional, Union
+from attrs import define, Factory
+from sqlalchemy import select, func, literal_column, text
+import re
+import uuid
+
+from db import City, CityData, FacetCount, facet_columns, fts_table
+
+# Columns that can be searched on, these all have an index.
+search_columns = ["disaster", "weather", "game_level", "city_status", "started"]
+# Columns that can be searched on by range.
+range_columns = ["total_pop", "funds", "crime", "pollution", "value", "started"]
+page_size = 24
+# Column weights for ranking name matches, in the order of the fts columns: name, city_path, tags.
+fts_weights = (10.0, 1.0, 2.0)
+
+
+def fts_query(query: str) -> Optional[str]:
+    """
+    Turns what someone typed into an FTS5 query, every word has to match the start of a word.
+    Returns:
+        The query, or None if there weren't any words in it.
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    return " ".join(f'"{x}"*' for x in words)
+
+
+def name_search(db_session, query: str, limit: int = 10) -> List[Tuple[uuid.UUID, str]]:
+    """
+    Prefix search over city names, paths and tags, for autocomplete. Best matches first.
+    Returns:
+        List of (city id, name).
+    """
+    q = fts_query(query)
+    if q is None:
+        return []
+    rows = db_session.execute(
+        text(f"SELECT city_id, name FROM {fts_table} WHERE {fts_table} MATCH :q ORDER BY bm25({fts_table}, {', '.join(map(str, fts_weights))}) LIMIT :limit"),
+        {"q": q, "limit": limit},
+    )
+    return [(uuid.UUID(city_id), name) for city_id, name in rows]
+
+
+@define
+class CityQuery:
+    """
+    A set of predicates over CityData, all of which have to match.
+    Args:
+        equals (dict): column name to value, the column must be in search_columns.
+        ranges (dict): column name to (min, max), inclusive. Either can be None for no limit. The column must be in range_columns.
+        name (str): words that have to match the start of words in the city's name, path or tags.
+    """
+    equals: Dict[str, Any] = Factory(dict)
+    ranges: Dict[str, Tuple[Optional[int], Optional[int]]] = Factory(dict)
+    name: Optional[str] = None
+
+    def conditions(self, exclude: Optional[str] = None) -> list:
+        """SQL conditions for the query, optionally leaving out the equality test on one column."""
+        conds = []
+        for k, v in self.equals.items():
+            if k not in search_columns:
+                raise ValueError(f"Can't search on {k}.")
+            if k == exclude:
+                continue
+            col = getattr(CityData, k)
+            # Match the column type, weather is stored as a string.
+            conds += [col == col.type.python_type(v)]
+        for k, (low, high) in self.ranges.items():
+            if k not in range_columns:
+                raise ValueError(f"Can't search on a range of {k}.")
+            col = getattr(CityData, k)
+            if low is not None:
+                conds += [col >= low]
+            if high is not None:
+                conds += [col <= high]
+        q = fts_query(self.name) if self.name else None
+        if q is not None:
+            matches = select(literal_column("city_id")).select_from(text(fts_table)).where(text(f"{fts_table} MATCH :fts").bindparams(fts=q))
+            conds += [CityData.id.in_(matches)]
+        return conds
+
+
+@define
+class Page:
+    """
+    One page of search results. total is None if the matches weren't counted.
+    last_rowid is the city_data rowid of the last item, pass it as after= to get the next page.
+    """
+    items: List[Tuple[City, CityData]]
+    total: Optional[int]
+    page: int
+    page_size: int
+    last_rowid: Optional[int] = None
+
+    @property
+    def pages(self) -> Optional[int]:
+        return None if self.total is None else max(1, -(-self.total // self.page_size))
+
+
+def count_cities(db_session, query: CityQuery) -> int:
+    """Number of cities matching the query. Only needs city_data, so there's no join."""
+    return db_session.scalar(select(func.count()).select_from(CityData).where(*query.conditions()))
+
+
+def search_cities(
+    db_session, query: Union[CityQuery, Dict[str, Any]], page: int = 0, page_size: int = page_size, count: bool = True, after: Optional[int] = None
+) -> Page:
+    """
+    Finds cities matching the query, using the indexes on city_data rather than looking at every city.
+    Args:
+        db_session (Session): database session.
+        query (CityQuery | dict): what to search for, a dict is column name to value for exact matches.
+        page (int): page number, starting from 0. Only used without after, skipping pages reads every row on them.
+        page_size (int): cities per page.
+        count (bool): also count every match for Page.total. Turn it off when fetching more pages of a search
+            that's already been counted, it can take longer than the page itself.
+        after (int): Page.last_rowid of the previous page, to carry on from it without an OFFSET.
+    Returns:
+        Page of (City, CityData) tuples, in the order they were added.
+    """
+    if isinstance(query, dict):
+        query = CityQuery(equals=query)
+    conds = query.conditions()
+    total = count_cities(db_session, query) if count else None
+    rowid = literal_column("city_data.rowid")
+    q = select(City, CityData, rowid).join(CityData, City.id == CityData.id).where(*conds)
+    # Paged by keyset, rowid > the last one seen, so a deep page costs the same as the first. With an equality test
+    # the index entries are already in rowid order, otherwise SQLite walks city_data by rowid from there until
+    # the page is full. Without a starting rowid a range test scans city_data, or an index plus a sort.
+    if after is not None:
+        q = q.where(rowid > after)
+    else:
+        q = q.offset(page * page_size)
+    rows = db_session.execute(q.order_by(rowid).limit(page_size)).all()
+    last_rowid = rows[-1][2] if rows else after
+    return Page([(c, d) for c, d, _ in rows], total, page, page_size, last_rowid)
+
+
+def facet_counts(db_session, query: Optional[CityQuery] = None) -> Dict[str, Dict[str, int]]:
+    """
+    Number of cities for each value of each of the facet_columns.
+    Each facet is counted over the cities matching the query, ignoring the query's own test on that facet
+    so the UI can show what picking a different value would give. Facets with nothing else to filter on
+    come from the precomputed facet_counts table.
+    Returns:
+        Dictionary of facet to (value as a string to count).
+    """
+    precomputed = None
+    counts = {}
+    for facet in facet_columns:
+        conds = query.conditions(exclude=facet) if query is not None else []
+        if not conds:
+            # Nothing else narrows this facet down (no query, or only a test on this facet), so it's the
+            # count over every city, which is kept up to date in facet_counts.
+            if precomputed is None:
+                precomputed = {x: {} for x in facet_columns}
+                for f in db_session.scalars(select(FacetCount)):
+                    if f.facet in precomputed:
+                        precomputed[f.facet][f.value] = f.count
+            counts[facet] = precomputed[facet]
+            continue
+        col = getattr(CityData, facet)
+        q = select(col, func.count()).where(*conds).group_by(col)
+        counts[facet] = {str(value): count for value, count in db_session.execute(q)}
+    return counts
@@ -0,0 +1,86 @@
+from typing import Callable, Optional
+from pathlib import Path
+import mimetypes
+import re
+
+from fastapi import Request
+from fastapi.responses import Response, FileResponse
+from starlette.concurrency import run_in_threadpool
+
+# Renders and city files are named by (or looked up by) a hash of their content, so they never change.
+immutable = "public, max-age=31536000, immutable"
+# A render name: 32 hex digits (render key, or a uuid for older cities), an optional size suffix and the format.
+image_name = re.compile(r"^[0-9a-f]{32}(_[a-z]+)?\.(jpg|webp|avif)$")
+city_hash_re = re.compile(r"^[0-9a-f]{32}$")
+render_key_re = re.compile(r"^[0-9a-f]{32}$")
+tile_name = re.compile(r"^\d+_\d+\.(jpg|webp|png)$")
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    tags = [x.strip().removeprefix("W/") for x in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+def file_response(request: Request, path: Path, etag: str, media_type: Optional[str] = None, filename: Optional[str] = None, cache_control: str = immutable) -> Response:
+    """
+    Serves a file with an ETag and Cache-Control, answering conditional GETs with 304.
+    Byte ranges (and If-Range against the ETag) are left to FileResponse, which streams them from the file.
+    Args:
+        request (Request): the request.
+        path (Path): file to send.
+        etag (str): strong validator for the file, without quotes.
+        media_type (str): content type, guessed from the name if not given.
+        filename (str): if given, the file is sent as a download with this name.
+        cache_control (str): Cache-Control header.
+    """
+    etag = f'"{etag}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if filename is not None:
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    if media_type is None:
+        media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+def add_routes(app, city_images: Path, city_file: Callable[[str], Optional[Path]]):
+    """
+    Adds the image and download routes.
+    Args:
+        app (FastAPI): app to add them to.
+        city_images (Path): where the renders are.
+        city_file (callable): takes a city hash and returns the path to its .sc2 file, or None if there isn't one
+            or it no longer has that hash.
+    """
+
+    @app.get("/img/{name}")
+    async def city_image(name: str, request: Request):
+        path = city_images / name
+        if image_name.match(name) is None or not path.is_file():
+            return Response(status_code=404)
+        return file_response(request, path, name)
+
+    @app.get("/download/{city_hash}")
+    async def city_download(city_hash: str, request: Request):
+        # city_file() hits the database, so it's kept off the event loop.
+        path = await run_in_threadpool(city_file, city_hash) if city_hash_re.match(city_hash) else None
+        if path is None or not path.is_file():
+            return Response(status_code=404)
+        return file_response(request, path, city_hash, "application/octet-stream", path.name)
+
+    @app.get("/tiles/{name}.dzi")
+    async def city_dzi(name: str, request: Request):
+        path = city_images / f"{name}.dzi"
+        if render_key_re.match(name) is None or not path.is_file():
+            return Response(status_code=404)
+        return file_response(request, path, f"{name}.dzi", "application/xml")
+
+    @app.get("/tiles/{name}_files/{level}/{tile}")
+    async def city_tile(name: str, level: int, tile: str, request: Request):
+        path = city_images / f"{name}_files" / str(level) / tile
+        if render_key_re.match(name) is None or tile_name.match(tile) is None or not path.is_file():
+            return Response(status_code=404)
+        return file_response(request, path, f"{name}-{level}-{tile}")
@@ -0,0 +1,145 @@
+from typing import List, Optional, Tuple
+from pathlib import Path
+from attrs import define, field, Factory
+from loguru import logger
+from sqlalchemy import select, literal_column, delete
+import argparse
+import os
+import uuid
+
+import numpy as np
+
+from db import City, CityFeatures, create_db, create_session, read_city_file, parse_city_bytes, run_jobs, db_dir, db_fn
+from features import city_features, feature_version, feature_length
+
+# Rows compared per step of a query, bounds the temporary float copy to about chunk_rows * feature_length * 4 bytes.
+chunk_rows = 16384
+
+
+@define
+class SimilarityIndex:
+    """
+    Exact nearest neighbours over the city feature vectors, by euclidean distance.
+    Vectors are kept as one (n, feature_length) uint8 matrix, feature_length bytes per city (~21MB for 100k cities).
+    A query is a chunked matrix-vector product over all of it, a few milliseconds at that size, and needs no
+    training or tuning, so new cities can just be appended.
+    """
+    ids: bytearray = field(default=Factory(bytearray))
+    vectors: np.ndarray = field(default=Factory(lambda: np.zeros((0, feature_length), dtype=np.uint8)))
+    # Squared length of each vector, so distances only need a dot product.
+    norms: np.ndarray = field(default=Factory(lambda: np.zeros(0, dtype=np.float32)))
+    _last_rowid: int = field(init=False, default=0)
+
+    @classmethod
+    def build(cls, db_session):
+        index = cls()
+        index.load_new(db_session)
+        return index
+
+    def load_new(self, db_session) -> int:
+        """Adds vectors stored since the index was built. Returns how many were added."""
+        rowid = literal_column("city_features.rowid")
+        q = select(rowid, CityFeatures.id, CityFeatures.vector).where(rowid > self._last_rowid, CityFeatures.version == feature_version)
+        ids = bytearray()
+        blobs = []
+        for r, city_id, vector in db_session.execute(q.order_by(rowid)):
+            self._last_rowid = r
+            if len(vector) != feature_length:
+                continue
+            ids += city_id.bytes
+            blobs += [vector]
+        if not blobs:
+            return 0
+        new = np.frombuffer(b"".join(blobs), dtype=np.uint8).reshape(-1, feature_length)
+        self.ids += ids
+        self.vectors = np.concatenate([self.vectors, new])
+        new_f = new.astype(np.float32)
+        self.norms = np.concatenate([self.norms, np.einsum("ij,ij->i", new_f, new_f)])
+        logger.info(f"Added {len(blobs)} cities to the similarity index, {len(self)} total.")
+        return len(blobs)
+
+    def __len__(self) -> int:
+        return len(self.ids) // 16
+
+    def city_id(self, i: int) -> uuid.UUID:
+        return uuid.UUID(bytes=bytes(self.ids[i * 16:(i + 1) * 16]))
+
+    def row(self, city_id: uuid.UUID) -> Optional[int]:
+        """Row for a city, or None if it has no vector. Only used once per query, so a scan is fine."""
+        i = self.ids.find(city_id.bytes)
+        # find() could match across the boundary of two ids, only aligned matches count.
+        while i != -1 and i % 16:
+            i = self.ids.find(city_id.bytes, i + 1)
+        return None if i == -1 else i // 16
+
+    def nearest(self, vector: np.ndarray, k: int = 10) -> List[Tuple[uuid.UUID, float]]:
+        """
+        The k closest cities to a vector.
+        Returns:
+            List of (city id, distance), closest first.
+        """
+        if len(self) == 0:
+            return []
+        q = vector.astype(np.float32)
+        distances = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), chunk_rows):
+            block = self.vectors[start:start + chunk_rows].astype(np.float32)
+            distances[start:start + len(block)] = self.norms[start:start + len(block)] - 2 * (block @ q)
+        distances += q @ q
+        k = min(k, len(self))
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        return [(self.city_id(int(i)), float(max(distances[i], 0.0)) ** 0.5) for i in top]
+
+    def similar(self, city_id: uuid.UUID, k: int = 10) -> List[Tuple[uuid.UUID, float]]:
+        """The k cities laid out most like this one, not counting itself. Empty if it has no vector."""
+        i = self.row(city_id)
+        if i is None:
+            return []
+        return [x for x in self.nearest(self.vectors[i], k + 1) if x[0] != city_id][:k]
+
+
+def file_features(path: Path) -> bytes:
+    """Features for a city file, for backfilling cities ingested before they were kept."""
+    return city_features(parse_city_bytes(read_city_file(path), path))
+
+
+def backfill(db_session, workers: int = 1) -> int:
+    """
+    Makes feature vectors for every city that doesn't have a current one, by parsing its file again.
+    Returns:
+        Number of cities that got a vector.
+    """
+    current = select(CityFeatures.id).where(CityFeatures.version == feature_version)
+    todo = {Path(p): i for i, p in db_session.execute(select(City.id, City.city_path).where(City.id.not_in(current)))}
+    logger.info(f"{len(todo)} cities need feature vectors.")
+    db_session.execute(delete(CityFeatures).where(CityFeatures.id.in_(list(todo.values()))))
+    n = 0
+    for path, features, e in run_jobs(file_features, [x for x in todo if x.exists()], workers):
+        if e is not None or not features:
+            logger.warning(f"No features for {path}: {e}")
+            continue
+        db_session.add(CityFeatures(id=todo[path], version=feature_version, vector=features))
+        n += 1
+        if n % 1000 == 0:
+            db_session.commit()
+    db_session.commit()
+    logger.info(f"Added feature vectors for {n} cities.")
+    return n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make feature vectors for cities that don't have them, or find cities like one.")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes for the backfill.")
+    parser.add_argument("--like", type=uuid.UUID, help="Print the cities most like this city id instead of backfilling.")
+    parser.add_argument("-k", type=int, default=10, help="Number of similar cities to print.")
+    args = parser.parse_args()
+
+    p = Path(db_dir) / db_fn
+    create_db(p)
+    db_session = create_session(p)
+    if args.like is None:
+        backfill(db_session, args.workers)
+    else:
+        for city_id, distance in SimilarityIndex.build(db_session).similar(args.like, args.k):
+            print(city_id, f"{distance:.1f}")
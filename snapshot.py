@@ -0,0 +1,174 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+from pathlib import Path
+from attrs import define, field, Factory
+from loguru import logger
+from sqlalchemy import select, literal_column
+import argparse
+import json
+import os
+
+import numpy as np
+
+from db import CityData, create_session, db_dir, db_fn
+from city_index import index_fields
+from ingest_stats import write_json
+
+# Where the snapshot lives, one raw little-endian array file per column plus snapshot.json saying how long they are.
+snapshot_dir = Path(db_dir) / "snapshot"
+# Array typecodes from city_index.index_fields, as numpy dtypes.
+dtypes = {"q": "<i8", "i": "<i4", "h": "<i2"}
+columns = {k: np.dtype(dtypes[v]) for k, v in index_fields.items()}
+# Rows read from the database per chunk when updating.
+chunk_rows = 50000
+
+
+def meta_file(path: Path) -> Path:
+    return Path(path) / "snapshot.json"
+
+
+def column_file(path: Path, name: str) -> Path:
+    return Path(path) / f"{name}.bin"
+
+
+def read_meta(path: Path) -> dict:
+    try:
+        return json.loads(meta_file(path).read_text())
+    except (OSError, ValueError):
+        return {"rows": 0, "last_rowid": 0}
+
+
+def update_snapshot(db_session, path: Path = snapshot_dir, rebuild: bool = False) -> int:
+    """
+    Appends any cities added since the snapshot was last updated, or builds it from scratch if there isn't one.
+    Each column is appended to its file, and snapshot.json is only rewritten after all of them, so a reader never
+    sees a column longer than the others. Anything past the recorded length from an interrupted update is cut off first.
+    A build from scratch is written to new files that replace the old ones at the end, as the website may have the old
+    ones memory mapped, and cutting a mapped file short under it would crash it. Only appends happen in place.
+    Args:
+        rebuild (bool): start again from scratch, even if the snapshot is up to date.
+    Returns:
+        Number of cities added.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    meta = read_meta(path)
+    if meta.get("columns") not in (None, list(columns)):
+        logger.info("Snapshot columns have changed, rebuilding it.")
+        meta = {"rows": 0, "last_rowid": 0}
+    if rebuild or any(not column_file(path, x).exists() or column_file(path, x).stat().st_size < meta["rows"] * d.itemsize for x, d in columns.items()):
+        meta = {"rows": 0, "last_rowid": 0}
+    rows, last_rowid = meta["rows"], meta["last_rowid"]
+    fresh = rows == 0
+    files = {x: Path(f"{column_file(path, x)}.tmp") if fresh else column_file(path, x) for x in columns}
+    for name, dtype in columns.items():
+        if fresh:
+            open(files[name], "wb").close()
+        else:
+            # Readers only map the recorded length, so what's past it can go.
+            with open(files[name], "ab") as out:
+                out.truncate(rows * dtype.itemsize)
+
+    rowid = literal_column("city_data.rowid")
+    q = select(rowid, *[getattr(CityData, x) for x in columns]).where(rowid > last_rowid).order_by(rowid)
+    added = 0
+    result = db_session.execute(q.execution_options(yield_per=chunk_rows))
+    for chunk in result.partitions(chunk_rows):
+        # Weather is stored as a string, but is always a number.
+        data = np.array([[int(x) for x in row] for row in chunk], dtype=np.int64)
+        for i, (name, dtype) in enumerate(columns.items()):
+            with open(files[name], "ab") as out:
+                out.write(data[:, i + 1].astype(dtype).tobytes())
+        last_rowid = int(data[-1, 0])
+        added += len(data)
+    if fresh:
+        for name in columns:
+            os.replace(files[name], column_file(path, name))
+    if added or "columns" not in meta:
+        write_json(meta_file(path), {"rows": rows + added, "last_rowid": last_rowid, "columns": list(columns)})
+    if added:
+        logger.info(f"Added {added} cities to the snapshot, {rows + added} total.")
+    return added
+
+
+@define
+class Snapshot:
+    """
+    Read-only columns of the numeric CityData fields for every city, memory mapped, so loading is instant and
+    only the pages a statistic touches are read. Columns are numpy arrays indexed the same way.
+    """
+    rows: int = 0
+    columns: Dict[str, np.ndarray] = field(default=Factory(dict))
+    version: Tuple[int, int] = (0, 0)
+
+    @classmethod
+    def load(cls, path: Path = snapshot_dir):
+        meta = read_meta(path)
+        rows = meta["rows"]
+        cols = {}
+        for name, dtype in columns.items():
+            if rows == 0:
+                cols[name] = np.zeros(0, dtype)
+            else:
+                cols[name] = np.memmap(column_file(path, name), dtype=dtype, mode="r", shape=(rows,))
+        return cls(rows, cols, (rows, meta["last_rowid"]))
+
+    def column(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def summary(self, name: str) -> Dict[str, float]:
+        x = self.columns[name]
+        if len(x) == 0:
+            return {"count": 0}
+        return {"count": len(x), "min": int(x.min()), "max": int(x.max()), "mean": float(x.mean()), "median": float(np.median(x))}
+
+    def percentiles(self, name: str, qs: Sequence[float] = (1, 5, 25, 50, 75, 95, 99)) -> Dict[float, float]:
+        x = self.columns[name]
+        if len(x) == 0:
+            return {}
+        return dict(zip(qs, np.percentile(x, qs).tolist()))
+
+    def histogram(self, name: str, bins: int = 20, log: bool = False) -> Tuple[List[float], List[int]]:
+        """
+        Histogram of a column.
+        Args:
+            log (bool): logarithmic bins, for things like population that span orders of magnitude. Values below 1 go in the first bin.
+        Returns:
+            (bin edges, counts), with one more edge than counts.
+        """
+        x = self.columns[name]
+        if len(x) == 0:
+            return [], []
+        if log:
+            top = max(int(x.max()), 1)
+            edges = np.unique(np.concatenate([[0], np.logspace(0, np.log10(top + 1), bins)]))
+        else:
+            edges = np.linspace(x.min(), x.max() + 1, bins + 1)
+        counts, edges = np.histogram(x, bins=edges)
+        return edges.tolist(), counts.tolist()
+
+    def breakdown(self, name: str) -> Dict[int, int]:
+        """Number of cities with each value, for categorical columns like disaster and weather."""
+        values, counts = np.unique(self.columns[name], return_counts=True)
+        return dict(zip(values.tolist(), counts.tolist()))
+
+    def where(self, name: str, low: Optional[int] = None, high: Optional[int] = None) -> np.ndarray:
+        """Boolean mask of the rows with low <= column <= high, to combine with & and | and index other columns with."""
+        x = self.columns[name]
+        mask = np.ones(len(x), dtype=bool)
+        if low is not None:
+            mask &= x >= low
+        if high is not None:
+            mask &= x <= high
+        return mask
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the columnar snapshot of city_data used for the statistics.")
+    parser.add_argument("--rebuild", action="store_true", help="Start the snapshot again from scratch.")
+    args = parser.parse_args()
+
+    db_session = create_session(Path(db_dir) / db_fn)
+    update_snapshot(db_session, rebuild=args.rebuild)
+    snap = Snapshot.load()
+    for name in ("total_pop", "funds", "crime"):
+        logger.info(f"{name}: {snap.summary(name)}")
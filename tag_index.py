@@ -0,0 +1,172 @@
+from typing import Dict, Iterable, Iterator, List, Optional
+from pathlib import Path
+from attrs import define, field, Factory
+from loguru import logger
+from sqlalchemy import select, insert
+import argparse
+import json
+import urllib.request
+import uuid
+
+from db import City, Tags, CityTags, create_session, update_fts_tags, db_dir, db_fn
+from city_index import CityIndex
+
+# Rows per statement for bulk tag assignment, well under SQLite's parameter limit.
+chunk_size = 5000
+# The running website's endpoint for tag changes, see backend.py.
+notify_url = "http://127.0.0.1:8080/api/tags/changed"
+
+
+def ordinals(bitmap: int) -> Iterator[int]:
+    """The set bits of a bitmap, lowest first."""
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    for i, byte in enumerate(data):
+        if not byte:
+            continue
+        for b in range(8):
+            if byte >> b & 1:
+                yield i * 8 + b
+
+
+def make_bitmap(members: Iterable[int]) -> int:
+    """Builds a bitmap from ordinals in one go, setting bits on an int one at a time would copy it every time."""
+    bits = bytearray()
+    for x in members:
+        if x // 8 >= len(bits):
+            bits.extend(bytes(x // 8 - len(bits) + 1))
+        bits[x // 8] |= 1 << (x % 8)
+    return int.from_bytes(bits, "little")
+
+
+@define
+class TagIndex:
+    """
+    One bitmap per tag over the dense city ordinals of a CityIndex, stored as a Python int.
+    AND/OR/NOT across tags are then single big-int operations instead of joins over city_tags.
+    Memory is one bit per city per tag.
+    """
+    index: CityIndex
+    bitmaps: Dict[str, int] = field(default=Factory(dict))
+
+    @classmethod
+    def build(cls, db_session, index: CityIndex):
+        tag_index = cls(index)
+        tag_index.rebuild(db_session)
+        return tag_index
+
+    def rebuild(self, db_session):
+        members = {}
+        q = select(Tags.name, CityTags.city_id).join(CityTags, CityTags.tag_id == Tags.id)
+        for name, city_id in db_session.execute(q):
+            ordinal = self.index.ordinal(city_id)
+            if ordinal is not None:
+                members.setdefault(name, []).append(ordinal)
+        self.bitmaps = {k: make_bitmap(v) for k, v in members.items()}
+        logger.info(f"Indexed {len(self.bitmaps)} tags.")
+
+    def add(self, tag: str, city_ids: Iterable[uuid.UUID]):
+        """Adds cities to a tag's bitmap, after they've been tagged in the database."""
+        new = make_bitmap(x for x in map(self.index.ordinal, city_ids) if x is not None)
+        self.bitmaps[tag] = self.bitmaps.get(tag, 0) | new
+
+    def everything(self) -> int:
+        return (1 << len(self.index)) - 1
+
+    def query(self, all_of: Iterable[str] = (), any_of: Iterable[str] = (), none_of: Iterable[str] = ()) -> int:
+        """
+        Cities with every tag in all_of, at least one in any_of (if given) and none in none_of.
+        Returns:
+            Bitmap of matching ordinals.
+        """
+        result = self.everything()
+        for tag in all_of:
+            result &= self.bitmaps.get(tag, 0)
+        any_of = list(any_of)
+        if any_of:
+            either = 0
+            for tag in any_of:
+                either |= self.bitmaps.get(tag, 0)
+            result &= either
+        for tag in none_of:
+            result &= ~self.bitmaps.get(tag, 0)
+        return result
+
+    @staticmethod
+    def count(bitmap: int) -> int:
+        return bitmap.bit_count()
+
+    def city_ids(self, bitmap: int, offset: int = 0, limit: Optional[int] = None) -> List[uuid.UUID]:
+        """Ids of the cities in a bitmap, in the order they were added."""
+        ids = []
+        for i, ordinal in enumerate(ordinals(bitmap)):
+            if i < offset:
+                continue
+            if limit is not None and len(ids) >= limit:
+                break
+            ids += [self.index.city_id(ordinal)]
+        return ids
+
+
+def get_or_create_tag(db_session, name: str, description: str = "", style: Optional[dict] = None) -> Tags:
+    tag = db_session.scalars(select(Tags).where(Tags.name == name)).first()
+    if tag is None:
+        tag = Tags(id=uuid.uuid4(), name=name, description=description, style=style or {})
+        db_session.add(tag)
+        db_session.flush()
+    return tag
+
+
+def assign_tags(db_session, name: str, city_ids: Iterable[uuid.UUID], tag_index: Optional[TagIndex] = None) -> int:
+    """
+    Tags a lot of cities at once, with bulk inserts in one transaction. Cities that already have the tag are skipped.
+    Args:
+        db_session (Session): database session.
+        name (str): tag name, created if it doesn't exist.
+        city_ids (iterable): cities to tag.
+        tag_index (TagIndex): if given, updated to match.
+    Returns:
+        How many cities were newly tagged.
+    """
+    tag = get_or_create_tag(db_session, name)
+    city_ids = list(dict.fromkeys(city_ids))
+    new = []
+    for i in range(0, len(city_ids), chunk_size):
+        chunk = city_ids[i:i + chunk_size]
+        q = select(CityTags.city_id).where(CityTags.tag_id == tag.id, CityTags.city_id.in_(chunk))
+        existing = set(db_session.scalars(q))
+        new += [x for x in chunk if x not in existing]
+    for i in range(0, len(new), chunk_size):
+        chunk = new[i:i + chunk_size]
+        db_session.execute(insert(CityTags), [{"id": uuid.uuid4(), "tag_id": tag.id, "city_id": x} for x in chunk])
+        update_fts_tags(db_session, chunk)
+    db_session.commit()
+    if tag_index is not None:
+        tag_index.add(name, new)
+    logger.info(f"Tagged {len(new)} cities with {name}.")
+    return len(new)
+
+
+def notify(url: str, name: str, city_ids: List[uuid.UUID]):
+    """Tells the running website which cities have been tagged, so the Collections tabs show them without a restart."""
+    body = json.dumps({"tag": name, "ids": [x.hex for x in city_ids]}).encode()
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            logger.info(f"Notified website of {len(city_ids)} cities tagged {name}, status: {resp.status}")
+    except OSError as e:
+        logger.warning(f"Couldn't notify website at {url}, error: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tag every city whose file matches a glob, e.g. for the Collections tabs.")
+    parser.add_argument("tag", help="Tag name, like Scenarios or Classic.")
+    parser.add_argument("pattern", help="Glob for the city files, relative to the current directory, like 'cities/classic/**/*.sc2'.")
+    parser.add_argument("--notify-url", default=notify_url, help="Website endpoint to tell about the tagged cities, '' to disable.")
+    args = parser.parse_args()
+
+    db_session = create_session(Path(db_dir) / db_fn)
+    paths = {str(x) for x in Path().glob(args.pattern)}
+    ids = [city_id for city_id, city_path in db_session.execute(select(City.id, City.city_path)) if city_path in paths]
+    assign_tags(db_session, args.tag, ids)
+    if args.notify_url and ids:
+        notify(args.notify_url, args.tag, ids)
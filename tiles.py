@@ -0,0 +1,56 @@
+from pathlib import Path
+from math import ceil, log2
+from PIL import Image
+
+# Deep Zoom (DZI) settings, these are what OpenSeadragon expects by default.
+tile_size = 254
+tile_overlap = 1
+tile_format = "jpg"
+tile_quality = 85
+
+
+def dzi_file(image_path) -> Path:
+    """The .dzi descriptor for a render, next to the render itself."""
+    image_path = Path(image_path)
+    return image_path.with_name(f"{image_path.name}.dzi")
+
+
+def tiles_dir(image_path) -> Path:
+    """Directory holding the tile pyramid for a render, one subdirectory per level."""
+    image_path = Path(image_path)
+    return image_path.with_name(f"{image_path.name}_files")
+
+
+def make_pyramid(img: Image.Image, image_path: Path):
+    """
+    Cuts a render into a Deep Zoom tile pyramid.
+    Level max_level is the full size image, each level below is half the size of the one above, down to 1x1 at level 0.
+    Each level is scaled down from the one above rather than from the full image.
+    The .dzi is written last, so it only exists if the whole pyramid does.
+    Args:
+        img (Image): full size render.
+        image_path (Path): render path without suffix.
+    """
+    w, h = img.size
+    max_level = ceil(log2(max(w, h)))
+    out_dir = tiles_dir(image_path)
+    level_img = img.convert("RGB")
+    for level in range(max_level, -1, -1):
+        scale = 2 ** (max_level - level)
+        size = (max(1, ceil(w / scale)), max(1, ceil(h / scale)))
+        if level_img.size != size:
+            level_img = level_img.resize(size, Image.Resampling.LANCZOS)
+        level_dir = out_dir / str(level)
+        level_dir.mkdir(parents=True, exist_ok=True)
+        for col in range(ceil(size[0] / tile_size)):
+            for row in range(ceil(size[1] / tile_size)):
+                x0 = max(0, col * tile_size - tile_overlap)
+                y0 = max(0, row * tile_size - tile_overlap)
+                x1 = min(size[0], (col + 1) * tile_size + tile_overlap)
+                y1 = min(size[1], (row + 1) * tile_size + tile_overlap)
+                level_img.crop((x0, y0, x1, y1)).save(level_dir / f"{col}_{row}.{tile_format}", quality=tile_quality)
+    dzi_file(image_path).write_text(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{tile_format}" Overlap="{tile_overlap}" TileSize="{tile_size}">'
+        f'<Size Width="{w}" Height="{h}"/></Image>\n'
+    )
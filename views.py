@@ -1,26 +1,49 @@
 from attrs import define, Factory, field
 
 from uuid import UUID
+from typing import List
+from pathlib import Path
 
 from nicegui import ui
 
 from models import CityModel
+from metrics import instrumented
 
 from loguru import logger
 
 from opencity2k.Data.value_mappings import disaster_type, weather_type
 
+# OpenSeadragon is vendored (see static/openseadragon/README.md), and served from here by backend.add_api_routes().
+openseadragon_dir = Path("static/openseadragon")
+openseadragon_url = "/static/openseadragon/"
+
+
+class DeepZoom(ui.element, component="deep_zoom.js"):
+    """
+    OpenSeadragon viewer for a tile pyramid, which only fetches the tiles visible at the current zoom.
+    It's started when the element is mounted, and loads OpenSeadragon the first time one is shown (see deep_zoom.js).
+    """
+
+    def __init__(self, dzi_url: str):
+        super().__init__()
+        self._props["tile-sources"] = dzi_url
+        self._props["prefix-url"] = openseadragon_url
+
+
 @define
 class CityView:
     model: CityModel
 
     @ui.refreshable
+    @instrumented("city_info")
     def city_info(self):
         with ui.column() as ui_info:
-            img = self.model.city_image
-            try:
-                ui.image(img).props('fit=scale-down')
-            except FileNotFoundError:
+            img = self.model.image("full", "webp")
+            if self.model.dzi_url is not None and (openseadragon_dir / "openseadragon.min.js").exists():
+                self.deep_zoom()
+            elif img.exists():
+                ui.image(self.model.image_url("full", "webp")).props('fit=scale-down')
+            else:
                 logger.error(f"image file not found: {img}")
                 ui.icon("broken_image").classes('text-5xl outline')
 
@@ -70,19 +93,19 @@ class CityView:
             ui.table(columns=cols, rows=rows)
             ui.label("Tags:")
             with ui.row().classes('gap-1'):
-                ui.chip("test1", color="red")
-                ui.chip("test2", color="orange")
-                ui.chip("test3", color="yellow", text_color="black")
-                ui.chip("test4", color="green")
-                ui.chip("test5", color="blue")
-                ui.chip("test6", color="purple")
+                for city_tag in self.model.db_city.city_tags:
+                    style = city_tag.tag.style or {}
+                    ui.chip(city_tag.tag.name, color=style.get("color", "primary"), text_color=style.get("text_color"))
             return ui_info
         
+    def deep_zoom(self):
+        return DeepZoom(self.model.dzi_url).classes("w-full h-[70vh]")
+
     @ui.refreshable
     def short_info(self, img: ui.image = None, stats: List = ["name"]):
         """stats is a list of stats to include."""
         with ui.row() as e:
-            t_img = self.model.city_thumb_image
+            t_img = self.model.image_url("gallery")
             if img is None:
                 i = ui.image(t_img)
             else:
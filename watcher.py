@@ -0,0 +1,179 @@
+from typing import Dict, Optional, Set, List
+from pathlib import Path
+from attrs import define, field, Factory
+from loguru import logger
+import argparse
+import json
+import os
+import threading
+import time
+import urllib.request
+import uuid
+
+from db import create_db, create_session, ingest_files, cities_dir, db_dir, db_fn, batch_size
+from ingest_stats import IngestStats, status_file
+from snapshot import update_snapshot
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    # Fall back to polling the directory.
+    FileSystemEventHandler = object
+    Observer = None
+
+
+notify_url = "http://127.0.0.1:8080/api/cities/ingested"
+# watchdog event types that can mean a file is new or has changed. Others, like opened and closed_no_write,
+# come from just reading a file, which ingest and the website's downloads do all the time.
+change_events = {"created", "modified", "moved", "closed"}
+
+
+class _CityEventHandler(FileSystemEventHandler):
+    """Passes any .sc2 file that was created, changed, moved into the directory or closed after writing to the watcher."""
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in change_events:
+            return
+        for p in (getattr(event, "dest_path", None), event.src_path):
+            if p and Path(p).suffix.lower() == ".sc2":
+                self.watcher.add_pending([Path(p)])
+
+
+@define
+class CityWatcher:
+    """
+    Watches a directory for new cities and ingests them.
+    Uses filesystem events if watchdog is installed, otherwise polls the directory.
+    Changes are debounced, so a burst of new files (or a file that's still being copied) is ingested in one go once it settles.
+    When polling, changes are only seen once per poll_interval, so a file has to go a whole poll without changing
+    before it's ingested, and the debounce is never shorter than that.
+    """
+    db_session: object
+    path: Path = cities_dir
+    debounce: float = 2.0
+    poll_interval: float = 5.0
+    workers: int = 1
+    batch_size: int = batch_size
+    notify_url: Optional[str] = notify_url
+    use_events: bool = True
+    tiles: bool = False
+    _pending: Set[Path] = field(init=False, default=Factory(set))
+    _last_change: float = field(init=False, default=0.0)
+    _lock: threading.Lock = field(init=False, default=Factory(threading.Lock))
+    _snapshot: Dict[Path, tuple] = field(init=False, default=Factory(dict))
+
+    def add_pending(self, paths: List[Path]):
+        with self._lock:
+            self._pending.update(paths)
+            self._last_change = time.monotonic()
+
+    def _take_pending(self, settle: float) -> List[Path]:
+        """Returns the pending paths once nothing has changed for settle seconds."""
+        with self._lock:
+            if not self._pending or time.monotonic() - self._last_change < settle:
+                return []
+            pending = sorted(self._pending)
+            self._pending.clear()
+        return [x for x in pending if x.is_file()]
+
+    def _scan(self) -> Dict[Path, tuple]:
+        snapshot = {}
+        for c in self.path.rglob("*.sc2"):
+            try:
+                st = c.stat()
+            except FileNotFoundError:
+                continue
+            snapshot[c] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def poll(self):
+        """Polling fallback, queues anything that's new or changed since the last scan."""
+        snapshot = self._scan()
+        changed = [c for c, s in snapshot.items() if self._snapshot.get(c) != s]
+        self._snapshot = snapshot
+        if changed:
+            self.add_pending(changed)
+
+    def ingest(self, paths: List[Path]) -> List[uuid.UUID]:
+        logger.info(f"Ingesting {len(paths)} new or changed cities.")
+        # Each run replaces the last one on the website's admin page.
+        stats = IngestStats(status_file)
+        _, _, added = ingest_files(paths, self.db_session, self.workers, self.batch_size, tiles=self.tiles, stats=stats)
+        if added:
+            update_snapshot(self.db_session)
+            self.notify(added)
+        return added
+
+    def notify(self, city_ids: List[uuid.UUID]):
+        """Tells the running website about the new cities, so they show up without a restart."""
+        if self.notify_url is None:
+            return
+        body = json.dumps({"ids": [x.hex for x in city_ids]}).encode()
+        req = urllib.request.Request(self.notify_url, data=body, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(req, timeout=10) as resp:
+                logger.info(f"Notified website of {len(city_ids)} cities, status: {resp.status}")
+        except OSError as e:
+            logger.warning(f"Couldn't notify website at {self.notify_url}, error: {e}")
+
+    def run(self):
+        """Runs until interrupted. Anything already in the directory is picked up on start."""
+        observer = None
+        if self.use_events and Observer is not None:
+            observer = Observer()
+            observer.schedule(_CityEventHandler(self), str(self.path), recursive=True)
+            observer.start()
+            logger.info(f"Watching {self.path} for new cities.")
+        else:
+            logger.info(f"Polling {self.path} for new cities every {self.poll_interval}s.")
+        settle = self.debounce if observer is not None else max(self.debounce, self.poll_interval)
+        self.add_pending(list(self._scan()))
+        try:
+            while True:
+                if observer is None:
+                    self.poll()
+                pending = self._take_pending(settle)
+                if pending:
+                    try:
+                        self.ingest(pending)
+                    except Exception:
+                        # Keep watching, and try the batch again once things settle.
+                        logger.exception(f"Ingesting {len(pending)} cities failed, will retry.")
+                        self.db_session.rollback()
+                        self.add_pending(pending)
+                time.sleep(self.poll_interval if observer is None else min(self.debounce, 1.0))
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch the cities directory and ingest new cities as they show up.")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes.")
+    parser.add_argument("-b", "--batch-size", type=int, default=batch_size, help="Number of cities per commit.")
+    parser.add_argument("-d", "--debounce", type=float, default=2.0, help="Seconds to wait for changes to settle, at least the poll interval when polling.")
+    parser.add_argument("--poll", action="store_true", help="Poll the directory instead of using filesystem events.")
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="Seconds between polls.")
+    parser.add_argument("--notify-url", default=notify_url, help="Website endpoint to tell about new cities, '' to disable.")
+    parser.add_argument("--tiles", action="store_true", help="Also make deep zoom tile pyramids for the renders.")
+    args = parser.parse_args()
+
+    p = Path(db_dir) / db_fn
+    create_db(p)
+    db_session = create_session(p)
+    watcher = CityWatcher(
+        db_session,
+        debounce=args.debounce,
+        poll_interval=args.poll_interval,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        notify_url=args.notify_url or None,
+        use_events=not args.poll,
+        tiles=args.tiles,
+    )
+    watcher.run()
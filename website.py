@@ -1,366 +1,567 @@
-from nicegui import ui, app, events
-from db import create_session
-from db import City as DbCity
-from db import CityData as DbCityData
-from pathlib import Path
+from nicegui import ui, app, events, run
+from fastapi import Request
+from db import get_leaderboard
 from loguru import logger
-from uuid import UUID
-from random import randint
 from attrs import define, field, Factory
-from sqlalchemy import column, text, desc
-import uuid
-from typing import Optional
+import time
+import math
+from typing import Optional, Callable, Tuple
 
-from typing import List
+from typing import List, Dict
 
 from opencity2k.Data.value_mappings import disaster_type, weather_type
 
 
+from search import search_cities, count_cities, facet_counts, name_search, CityQuery
 from views import CityView
 from models import CityModel
+from catalog import Catalog
+from ingest_stats import read_status, stages
+from metrics import instrumented
+from backend import sessions, catalog, cities_added, io_bound, run_db, get_tag_index, similar_cities, random_city
+from backend import get_snapshot, is_local, add_api_routes, warm_indexes
 
-sess = create_session()
-cities_dir = Path("cities")
-city_images = Path("city_images")
-
-@define
-class City:
-    city_id: uuid.UUID
-    db_city: DbCity
-    db_data: DbCityData
-
-    @property
-    def city_path(self):
-        return self.db_city.city_path
-    
-    @property
-    def image_path(self):
-        return self.db_city.image_path
-    
-    @property
-    def city_image(self):
-        return city_images / Path(f"{self.city_id.hex}.jpg")
-    
-    @property
-    def city_thumb_image(self):
-        return city_images / Path(f"{self.city_id.hex}_t.jpg")
-
-    @ui.refreshable
-    def city_info(self):
-        with ui.column() as ui_info:
-            img = self.city_image
-            try:
-                ui.image(img).props('fit=scale-down')
-            except FileNotFoundError:
-                logger.error(f"image file not found: {img}")
-                ui.icon("broken_image").classes('text-5xl outline')
-
-            cols = [
-                {"name": "name", "label": "City Name", "field": "name"},
-                {"name": "population", "label": "Population", "field": "population"},
-                # {"name": "arco_pop", "label": "Arco Pop", "field": "arco_pop"},
-                # {"name": "started", "label": "Start Year", "field": "started"},
-                {"name": "date", "label": "Date", "field": "date"},
-                {"name": "funds", "label": "Funds", "field": "funds"},
-                # {"name": "bonds", "label": "Bonds", "field": "bonds"},
-                # {"name": "game_level", "label": "Level", "field": "game_level"},
-                # {"name": "city_status", "label": "Status", "field": "city_status"},
-                {"name": "crime", "label": "Crime", "field": "crime"},
-                {"name": "traffic", "label": "Traffic", "field": "traffic"},
-                {"name": "pollution", "label": "Pollution", "field": "pollution"},
-                {"name": "value", "label": "Value", "field": "value"},
-                {"name": "weather", "label": "Weather", "field": "weather"},
-                {"name": "nat_pop", "label": "Nat'l Pop", "field": "nat_pop"},
-                {"name": "nat_val", "label": "Nat'l Val", "field": "nat_val"},
-                {"name": "disaster", "label": "Disaster", "field": "disaster"},
-                {"name": "unemployment", "label": "Unemployment", "field": "unemployment"},
-            ]
-
-            d = self.db_data
-            rows = [
-                {"name": d.name,
-                "population": f"{d.population + d.arco_pop:,}",
-                # "arco_pop": f"{d.arco_pop:,}",
-                "started": d.started, 
-                "date": d.date,
-                "funds": f"${d.funds:,}",
-                "bonds": f"${d.bonds:,}",
-                "game_level": f"{d.game_level:,}",
-                "city_status": f"{d.city_status:,}",
-                "crime": f"{d.crime:,}",
-                "traffic": f"{d.traffic:,}",
-                "pollution": f"{d.pollution:,}",
-                "value": f"${d.value * 1000:,}",
-                "weather": weather_type[int(d.weather)].title(),
-                "nat_pop": f"{d.nat_pop * 1000:,}",
-                "nat_val": f"${d.nat_val * 1000:,}",
-                "disaster": disaster_type[int(d.disaster)].title(),
-                "unemployment": f"{d.unemployment:,}",
-                },
-            ]
-            ui.table(columns=cols, rows=rows)
-            ui.label("Tags:")
-            with ui.row().classes('gap-1'):
-                ui.chip("test1", color="red")
-                ui.chip("test2", color="orange")
-                ui.chip("test3", color="yellow", text_color="black")
-                ui.chip("test4", color="green")
-                ui.chip("test5", color="blue")
-                ui.chip("test6", color="purple")
-            return ui_info
-        
-    @ui.refreshable
-    def short_info(self, img: ui.image = None, stats: List = ["name"]):
-        """stats is a list of stats to include."""
-        with ui.row() as e:
-            t_img = self.city_thumb_image
-            if img is None:
-                i = ui.image(t_img)
-            else:
-                i = ui.image(img)
-            # with ui.column():
-                # for x in stats:
-            #         d = self.db_data
-            #         ui.label(f"{x}: {getattr(d, x)}")
-            cols = [{"name": x, "label": x.title(), "field": x} for x in stats]
-            rows = []
-            d = self.db_data
-            for x in stats:
-                rows += [{x: getattr(d, x)}]
-            t = ui.table(columns=cols, rows=rows)
-        return e, i, t
-
-
-def get_all_cities():
-    cities = sess.query(DbCity).all()
-    cities_data = sess.query(DbCityData).all()
-    all_cities = {}
-    for x, y in zip(cities, cities_data):
-        assert x.id == y.id
-        c_id = x.id
-        c = City(c_id, x, y)
-        all_cities[c_id] = c
-    return all_cities
-
-
-all_cities = get_all_cities()
+# The engine, catalog, indexes and routes are set up once, in backend.py, and shared by every page.
+add_api_routes(app)
+app.on_startup(warm_indexes)
 
 
 @define
 class RandomCity:
-    city: City = field(init=None, default=None)
+    city: CityModel = field(init=None, default=None)
     ui_info: ui.row = field(init=None, default=None)
     search_res = field(init=None, default=None)
 
     @ui.refreshable
-    def random_city(self, all_cities):
+    def random_city(self, city: Optional[CityModel]):
         if self.ui_info is not None:
             self.ui_info.delete()
-        r = randint(0, len(all_cities))
-        self.city = list(all_cities.values())[r]
-        self.ui_info = self.city.city_info()
-
-def city_search(all_cities, key, val):
-    logger.info([key, val])
-    res = []
-    lightbox = CityScroller()
-    for k, v in all_cities.items():
-        # logger.info(v.db_data.weather)
-        # logger.info(type(v.db_data.weather))
-        if str(getattr(v.db_data, key)) == str(val):
-            res += [v]
-            lightbox.add_city(v).classes('w-[300px] h-[200px]')
-    with ui.column() as search_res:
-        logger.info(res)
-        for x in res:
-            with ui.expansion(x.db_data.name):
-                x.city_info()
-        
+            self.ui_info = None
+        self.city = city
+        if self.city is not None:
+            self.ui_info = CityView(self.city).city_info()
+            with self.ui_info:
+                similar_view(self.city)
+        else:
+            ui.notify("No cities match.")
+
+# Names for the values of each facet.
+facet_names = {"disaster": disaster_type, "weather": weather_type}
+# Labels for the columns that can be searched by range.
+range_labels = {
+    "total_pop": "Population",
+    "funds": "Funds",
+    "crime": "Crime",
+    "pollution": "Pollution",
+    "value": "Value",
+    "started": "Start Year",
+}
+
+
+@define
+class SearchView:
+    """Search form and a gallery of the results."""
+    query: CityQuery = field(default=Factory(CityQuery))
+    selects: dict = field(init=False, default=Factory(dict))
+    range_inputs: dict = field(init=False, default=Factory(dict))
+    name_input: ui.input = field(init=False, default=None)
+    results: ui.column = field(init=False, default=None)
+
+    def view(self):
+        with ui.row().classes('items-end'):
+            with ui.column():
+                ui.label("Name")
+                self.name_input = ui.input(on_change=lambda e: self.autocomplete(e.value)).props('debounce=250 clearable').classes('w-64')
+                self.name_input.on('keydown.enter', lambda: self.city_search())
+            for facet in facet_names:
+                with ui.column():
+                    ui.label(facet.title())
+                    self.selects[facet] = ui.select({}, clearable=True).classes('w-48')
+            for col, label in range_labels.items():
+                with ui.column():
+                    ui.label(label)
+                    with ui.row():
+                        low = ui.number("Min").classes('w-24')
+                        high = ui.number("Max").classes('w-24')
+                    self.range_inputs[col] = (low, high)
+            ui.button(icon="search", on_click=lambda: self.city_search())
+        self.results = ui.column().classes('w-full')
+        ui.timer(0, self.update_facets, once=True)
+
+    @instrumented("update_facets")
+    async def update_facets(self):
+        """Shows how many cities each option would give with the rest of the current search."""
+        counts = await run_db(facet_counts, self.query)
+        for facet, sel in self.selects.items():
+            options = {k: f"{v.title()} ({counts[facet].get(str(k), 0):,})" for k, v in facet_names[facet].items()}
+            sel.set_options(options, value=sel.value)
+
+    @instrumented("autocomplete")
+    async def autocomplete(self, value):
+        names = await run_db(name_search, value or "")
+        self.name_input.set_autocomplete([name for _, name in names])
+
+    @instrumented("city_search")
+    async def city_search(self):
+        equals = {k: x.value for k, x in self.selects.items() if x.value is not None}
+        ranges = {}
+        for col, (low, high) in self.range_inputs.items():
+            if low.value is not None or high.value is not None:
+                ranges[col] = tuple(None if x.value is None else int(x.value) for x in (low, high))
+        self.query = CityQuery(equals, ranges, self.name_input.value or None)
+        logger.info(self.query)
+        await self.show_results()
+        await self.update_facets()
+
+    async def show_results(self):
+        query = self.query
+        total = await run_db(count_cities, query)
+        # Where each page starts, the scroller asks for them in order.
+        starts = {0: 0}
+
+        def fetch(page, size):
+            with sessions() as db_session:
+                result = search_cities(db_session, query, page, size, count=False, after=starts[page])
+            starts[page + 1] = result.last_rowid
+            ids = [c.id for c, _ in result.items]
+            # Through the catalog, so the cities come with their tags and are cached.
+            return catalog.get_many(ids)
+
+        self.results.clear()
+        with self.results:
+            ui.label(f"Found {total:,} cities.")
+            CityScroller(fetch)
+
+
 @define
 class CityScroller:
-    city_list: List[City] = field(default=Factory(list))
+    """
+    Gallery of city thumbnails, fetched a page at a time as it's scrolled.
+    Each page of cards is its own block. Blocks scrolled well out of view are emptied down to a spacer of the same
+    height and filled in again when they come back, so however far it's scrolled there are only a few pages of
+    cards in the browser.
+    The full size image and details are only built when a card is opened.
+    fetch is called in a worker thread, so it can block.
+    """
+    fetch: Callable[[int, int], List[CityModel]]
+    page_size: int = 48
+    # How far out of view, in screen heights, a page of cards is kept.
+    keep_screens: float = 2.0
+    city_list: List[CityModel] = field(default=Factory(list))
+    next_page: int = field(init=False, default=0)
+    done: bool = field(init=False, default=False)
+    # Scrolling fires lots of events, this stops them all fetching the same page.
+    loading: bool = field(init=False, default=False)
+    current: int = field(init=False, default=0)
     dialog: ui.dialog = field(init=False)
-    large_image: ui.image = field(init=False)
+    detail: ui.column = field(init=False)
+    grid: ui.column = field(init=False)
+    more: ui.button = field(init=False)
+    # One row of cards per page, and the spacer height of the ones that have been emptied.
+    blocks: List[ui.row] = field(init=False, default=Factory(list))
+    emptied: Dict[int, float] = field(init=False, default=Factory(dict))
+    _last_window: float = field(init=False, default=0.0)
 
     def __attrs_post_init__(self):
         with ui.dialog().props('maximized').classes('bg-black') as self.dialog:
             ui.keyboard(self._handle_key)
-            self.large_image = ui.image().props('no-spinner fit=scale-down')
-
-    def add_city(self, city: City) -> ui.image:
+            self.detail = ui.column().classes('w-full items-center')
+        with ui.scroll_area(on_scroll=self._handle_scroll).classes('w-full h-[75vh]'):
+            self.grid = ui.column().classes('w-full gap-2')
+            # In case the first page doesn't fill the scroll area, so there's nothing to scroll.
+            self.more = ui.button("More", on_click=self.load_more).props('flat')
+        ui.timer(0, self.load_more, once=True)
+
+    @instrumented("load_more")
+    async def load_more(self):
+        if self.done or self.loading:
+            return
+        self.loading = True
+        try:
+            cities = await io_bound(self.fetch, self.next_page, self.page_size)
+        finally:
+            self.loading = False
+        self.next_page += 1
+        if len(cities) < self.page_size:
+            self.done = True
+            self.more.set_visibility(False)
+        for city in cities:
+            self.add_city(city)
+        await self.update_window()
+
+    def add_city(self, city: CityModel) -> ui.card:
+        idx = len(self.city_list)
         self.city_list += [city]
-        img = city_images / Path(f"{city.city_id.hex}.jpg")
-        # t_img = city_images / Path(f"{city.city_id.hex}_t.jpg")
-        # with ui.button(on_click=lambda: self._open(img)).props('flat dense square'):
-            # return ui.image(t_img)
-            # return city.short_info(["name", "disaster"])
-        e, i, t = city.short_info(img, ["name", "disaster"])
-        with ui.button(on_click=lambda: self._open(img)).props('flat dense square'):
-            return ui.image(img)
-        return e
-        # return ui.image(img)
-        # return ui.image(city.image_path)
+        if idx % self.page_size == 0:
+            with self.grid:
+                self.blocks += [ui.row().classes('gap-2')]
+        with self.blocks[-1]:
+            return self._card(idx)
+
+    def _card(self, idx: int) -> ui.card:
+        city = self.city_list[idx]
+        with ui.card().tight().classes('w-[300px] cursor-pointer').on('click', lambda: self._open(idx)) as card:
+            ui.image(city.image_url("gallery", "webp"))
+            with ui.card_section():
+                ui.label(city.db_data.name)
+        return card
+
+    async def update_window(self) -> None:
+        """Empties the pages of cards that are far out of view, and fills in any emptied ones that are close again."""
+        self._last_window = time.monotonic()
+        ids = [x.id for x in self.blocks]
+        js = f"[window.innerHeight, {ids}.map(id => {{ const r = document.getElementById('c' + id).getBoundingClientRect(); return [r.top, r.bottom]; }})]"
+        try:
+            view, rects = await ui.run_javascript(js, timeout=2.0)
+        except (TimeoutError, RuntimeError):
+            # Measured in the browser, so there's nothing to do if it's gone.
+            return
+        margin = view * self.keep_screens
+        for page, (block, (top, bottom)) in enumerate(zip(self.blocks, rects)):
+            near = bottom > -margin and top < view + margin
+            if not near and page not in self.emptied:
+                self.emptied[page] = bottom - top
+                block.clear()
+                block.style(f"height: {bottom - top}px")
+            elif near and page in self.emptied:
+                block.style(remove=f"height: {self.emptied.pop(page)}px")
+                with block:
+                    for idx in range(page * self.page_size, min((page + 1) * self.page_size, len(self.city_list))):
+                        self._card(idx)
+
+    async def _handle_scroll(self, event_args: events.ScrollEventArguments) -> None:
+        if event_args.vertical_percentage > 0.9:
+            await self.load_more()
+        elif time.monotonic() - self._last_window > 0.5:
+            await self.update_window()
 
     def _handle_key(self, event_args: events.KeyEventArguments) -> None:
         if not event_args.action.keydown:
             return
         if event_args.key.escape:
             self.dialog.close()
-        # image_index = self.image_list.index(self.large_image.source)
-        # if event_args.key.arrow_left and image_index > 0:
-        #     self._open(self.image_list[image_index - 1])
-        # if event_args.key.arrow_right and image_index < len(self.image_list) - 1:
-        #     self._open(self.image_list[image_index + 1])
-
-    def _open(self, url: str) -> None:
-        self.large_image.set_source(url)
+        if event_args.key.arrow_left and self.current > 0:
+            self._open(self.current - 1)
+        if event_args.key.arrow_right and self.current < len(self.city_list) - 1:
+            self._open(self.current + 1)
+
+    @instrumented("open_city")
+    def _open(self, idx: int) -> None:
+        self.current = idx
+        self.detail.clear()
+        with self.detail:
+            CityView(self.city_list[idx]).city_info()
+            similar_view(self.city_list[idx])
         self.dialog.open()
 
-app.add_static_files('/cities', 'cities')
-sess = create_session()
-cities_dir = Path("cities")
-city_images = Path("city_images")
 
+def similar_view(city: CityModel):
+    """A button that shows the cities laid out most like this one, see similarity.py."""
+    container = ui.row().classes('gap-2')
+
+    @instrumented("similar_cities")
+    async def show():
+        cities = await io_bound(similar_cities, city.city_id)
+        container.clear()
+        with container:
+            if not cities:
+                ui.label("No similar cities found.")
+            for other in cities:
+                with ui.card().tight().classes('w-[150px]'):
+                    ui.image(other.image_url("gallery", "webp"))
+                    with ui.card_section():
+                        ui.label(other.db_data.name)
+
+    ui.button("Similar Cities", on_click=show, icon="compare").props('flat')
 
 @define
 class RandomView:
-    all_cities: list[City]
+    catalog: Catalog
     dl_path: str = ''
-    r: RandomCity = field(init=None, default=RandomCity())
+    r: RandomCity = field(init=None, default=Factory(RandomCity))
+    disaster: ui.select = field(init=False, default=None)
+    min_pop: ui.number = field(init=False, default=None)
 
     def view(self):
-        with ui.row():
+        with ui.row().classes('items-end'):
             ui.button("Download City", on_click=lambda: ui.download(self.dl_path), icon="download")
-            ui.button("Random", on_click=lambda: self.get_random_city(), color="secondary", icon="refresh")
-        self.get_random_city()
+            ui.button("Random", on_click=self.get_random_city, color="secondary", icon="refresh")
+            self.disaster = ui.select({k: v.title() for k, v in disaster_type.items()}, label="Disaster", clearable=True).classes('w-48')
+            self.min_pop = ui.number("Min Population").classes('w-36')
+        # Deferred, so the page shows while the sampler is still being built (see warm_indexes()).
+        ui.timer(0, self.get_random_city, once=True)
+
+    @instrumented("get_random_city")
+    async def get_random_city(self):
+        disaster = self.disaster.value
+        min_pop = None if self.min_pop.value is None else int(self.min_pop.value)
+        facet = None if disaster is None else "disaster"
+        city = await io_bound(random_city, facet, disaster, min_pop)
+        self.r.random_city(city)
+        if self.r.city is not None:
+            self.dl_path = self.r.city.download_url
+
 
-    def get_random_city(self):
-        self.r.random_city(self.all_cities)
-        self.dl_path = self.r.city.city_path
 
-# all_cities = sess.query(DbCity).all()
+# Title and line format for each of the leaderboards.
+ranking_text = {
+    "population": ("Highest Population", "City: {name} has {score:,} sims."),
+    "funds": ("Highest Funds", "City: {name} has ${score:,}."),
+    "crime": ("Highest Crime", "City: {name} has {score:,}."),
+    "value": ("Highest Value", "City: {name} has {score:,}."),
+}
 
 
-def view_city(city_id, all_cities):
+def all_leaderboards(db_session) -> Dict[str, list]:
+    return {board: get_leaderboard(db_session, board) for board in ranking_text}
+
+
+@define
+class RankingView:
+    """The leaderboards. Each page has its own, and they're all refreshed whenever the watcher adds cities."""
+    boards: Dict[str, list] = field(init=False, default=Factory(dict))
+
+    def view(self):
+        self.ranking_boards()
+        # Deferred like the statistics.
+        ui.timer(0, self.refresh, once=True)
+        # Subscribed from inside the page, so it's dropped again when the page goes away.
+        cities_added.subscribe(self.refresh)
+
+    @ui.refreshable
+    def ranking_boards(self):
+        for board, (title, fmt) in ranking_text.items():
+            with ui.expansion(title):
+                with ui.column():
+                    for city_id, name, score in self.boards.get(board, []):
+                        ui.label(fmt.format(name=name, score=score))
+
+    @instrumented("ranking")
+    async def refresh(self):
+        """Reloads the leaderboards, after the page loads and again whenever the watcher adds cities."""
+        self.boards = await run_db(all_leaderboards)
+        self.ranking_boards.refresh()
+
+
+# Collections tab, and its label. Each one is the cities with the tag of the same name (see tag_index.py).
+collections = {
+    "Scenarios": "Scenarios",
+    "Streets": "Streets Cities",
+    "Copter": "Copter Cities",
+    "Image": "Cities That Make an Image",
+    "Classic": "SimCity Classic Cities",
+    "Other": "Other Cities",
+}
+
+
+def collection_panel(tag: str, label: str):
+    """Gallery for one collection, filled in after the page loads so building the tag index doesn't hold it up."""
+    ui.label(label)
+    container = ui.column().classes('w-full')
+
+    @instrumented("collection")
+    async def fill():
+        tags = await io_bound(get_tag_index)
+        bitmap = tags.query(all_of=[tag])
+        with container:
+            ui.label(f"{tags.count(bitmap):,} cities")
+            CityScroller(lambda page, size: catalog.get_many(tags.city_ids(bitmap, page * size, size)))
+
+    ui.timer(0, fill, once=True)
+
+
+def view_city(city_id, catalog):
     ui.label(f"city_id={city_id}")
 
 
 
-with ui.header():
-    with ui.tabs() as tabs:
-        ui.tab("Search", icon="search")
-        ui.tab("City", icon="location_city")
-        ui.tab("Random", icon="shuffle")
-        ui.tab("Featured", icon="star")
-        ui.tab("Ranking", icon="timeline")
-        ui.tab("Collections", icon="list")
-        ui.tab("About", icon="question_mark")
+# Columns to show percentiles for, and their labels.
+percentile_columns = {"total_pop": "Population", "funds": "Funds", "crime": "Crime", "pollution": "Pollution", "value": "Value"}
+
+
+def archive_stats() -> dict:
+    """Everything the Statistics tab shows, worked out from the snapshot in one go."""
+    snap = get_snapshot()
+    return {
+        "rows": snap.rows,
+        "population": snap.histogram("total_pop", 16, log=True),
+        "percentiles": {k: snap.percentiles(k) for k in percentile_columns},
+        "disaster": snap.breakdown("disaster"),
+        "weather": snap.breakdown("weather"),
+    }
+
+
+def integer_bins(edges: List[float], counts: List[int]) -> Tuple[List[str], List[int]]:
+    """
+    Labels for a histogram of integer values. A bin [a, b) holds the integers ceil(a) to ceil(b) - 1, log bins
+    narrower than 1 can hold none, and those are left out.
+    Returns:
+        (labels, counts).
+    """
+    labels, kept = [], []
+    for a, b, n in zip(edges, edges[1:], counts):
+        low, high = math.ceil(a), math.ceil(b) - 1
+        if high < low:
+            continue
+        labels += [f"{low:,}" if low == high else f"{low:,}-{high:,}"]
+        kept += [n]
+    return labels, kept
+
+
+def bar_chart(labels: List[str], values: List[int], title: str) -> ui.echart:
+    return ui.echart({
+        "title": {"text": title, "textStyle": {"color": "#ccc"}},
+        "tooltip": {},
+        "xAxis": {"type": "category", "data": labels, "axisLabel": {"rotate": 45}},
+        "yAxis": {"type": "value"},
+        "series": [{"type": "bar", "data": values}],
+    }).classes('w-full h-80')
+
+
+@instrumented("statistics")
+async def statistics_panel(container: ui.column):
+    stats = await io_bound(archive_stats)
+    container.clear()
+    with container:
+        if stats["rows"] == 0:
+            ui.label("No statistics yet, run python snapshot.py to make the snapshot.")
+            return
+        ui.label(f"{stats['rows']:,} cities.")
+        bar_chart(*integer_bins(*stats["population"]), "Population")
+        cols = [{"name": "column", "label": "", "field": "column", "align": "left"}]
+        qs = list(next(iter(stats["percentiles"].values())))
+        cols += [{"name": str(q), "label": f"{q}%", "field": str(q)} for q in qs]
+        rows = [dict({"column": percentile_columns[k]}, **{str(q): f"{v:,.0f}" for q, v in p.items()}) for k, p in stats["percentiles"].items()]
+        ui.table(columns=cols, rows=rows, row_key="column")
+        with ui.row().classes('w-full no-wrap'):
+            for facet in ("disaster", "weather"):
+                names = facet_names[facet]
+                counts = stats[facet]
+                bar_chart([names.get(k, str(k)).title() for k in counts], list(counts.values()), facet.title())
+
+
+@define
+class IngestView:
+    """Live counters for the current or last ingest, from the status file it writes (see ingest_stats)."""
+    summary: ui.label = field(init=False, default=None)
+    stage_table: ui.table = field(init=False, default=None)
+    slow_table: ui.table = field(init=False, default=None)
+    fail_table: ui.table = field(init=False, default=None)
+
+    def view(self):
+        self.summary = ui.label("No ingest has run yet.")
+        ui.label("Stages")
+        cols = [{"name": x, "label": x.replace("_", " ").title(), "field": x} for x in ("stage", "wall_s", "cpu_s", "count", "mean_ms")]
+        self.stage_table = ui.table(columns=cols, rows=[], row_key="stage")
+        ui.label("Slowest Files")
+        cols = [{"name": "path", "label": "Path", "field": "path", "align": "left"}, {"name": "wall_s", "label": "Wall S", "field": "wall_s"}]
+        cols += [{"name": x, "label": x.title(), "field": x} for x in stages[:-1]]
+        self.slow_table = ui.table(columns=cols, rows=[], row_key="path")
+        ui.label("Failure Causes")
+        cols = [{"name": x, "label": x.title(), "field": x} for x in ("cause", "count")]
+        self.fail_table = ui.table(columns=cols, rows=[], row_key="cause")
+        ui.timer(2.0, self.update)
+
+    async def update(self):
+        status = await run.io_bound(read_status)
+        if status is None:
+            return
+        state = "Running" if status["running"] else "Finished"
+        self.summary.set_text(
+            f"{state}: {status['done']:,} of {status['total']:,} files in {status['elapsed_s']:.0f}s "
+            f"({status['rate_per_s']:.1f}/s). {', '.join(f'{k} {v:,}' for k, v in status['outcomes'].items())}."
+        )
+        self.stage_table.rows = [
+            {"stage": k, "wall_s": f"{v['wall_s']:.1f}", "cpu_s": f"{v['cpu_s']:.1f}", "count": v["count"], "mean_ms": f"{v['mean_ms']:.1f}"}
+            for k, v in status["stages"].items()
+        ]
+        self.slow_table.rows = [
+            dict({"path": x["path"], "wall_s": f"{x['wall_s']:.2f}"}, **{k: f"{v:.2f}" for k, v in x["stages"].items()})
+            for x in status["slowest"]
+        ]
+        self.fail_table.rows = [{"cause": k, "count": v} for k, v in status["failures"].items()]
+        for table in (self.stage_table, self.slow_table, self.fail_table):
+            table.update()
+
+
+@ui.page("/admin")
+def admin_page(request: Request):
+    """Ingest progress and timings. Only for local users, like the ingest endpoint."""
+    ui.dark_mode().enable()
+    if not is_local(request):
+        ui.label("Forbidden")
+        return
+    ui.label("Ingest").classes('text-h5')
+    IngestView().view()
+
+
+@ui.page("/")
+def index_page():
+    """
+    The site. It's all built in here rather than at the top level, so each visitor gets their own page, and the
+    module (with the engine, catalog and routes) is only run once, not again for every visit.
+    """
+    ui.dark_mode().enable()
+
+    with ui.header():
+        with ui.tabs() as tabs:
+            ui.tab("Search", icon="search")
+            ui.tab("City", icon="location_city")
+            ui.tab("Random", icon="shuffle")
+            ui.tab("Featured", icon="star")
+            ui.tab("Ranking", icon="timeline")
+            ui.tab("Statistics", icon="bar_chart")
+            ui.tab("Collections", icon="list")
+            ui.tab("About", icon="question_mark")
+
+    with ui.tab_panels(tabs, value="Random").classes('w-full') as tp:
+        with ui.tab_panel("Search"):
+            ui.label("Search Cities")
+            search_view = SearchView()
+            search_view.view()
+
+        with ui.tab_panel("Random"):
+            rand = RandomView(catalog)
+            rand.view()
+
+
+        with ui.tab_panel("Featured"):
+            ui.label("Featured Cities")
+
+        with ui.tab_panel("Ranking"):
+            ui.label("Ranked Cities")
+            RankingView().view()
+
+        with ui.tab_panel("Statistics"):
+            ui.label("Archive Statistics")
+            stats_container = ui.column().classes('w-full')
+            # Deferred, so loading the snapshot doesn't hold up the page.
+            ui.timer(0, lambda: statistics_panel(stats_container), once=True)
+
+        with ui.tab_panel("Collections"):
+            with ui.tabs() as coll_tabs:
+                ui.tab("Scenarios", icon="volcano")
+                ui.tab("Streets", icon="directions_car")
+                ui.tab("Copter", icon="flight")  # Why doesn't icon="helicopter" work?
+                ui.tab("Image", icon="photo")
+                ui.tab("Classic", icon="corporate_fare")
+                ui.tab("Other", icon="other_houses")
+
+            with ui.tab_panels(coll_tabs, value="Scenarios").classes("w-full"):
+
+                for tab, label in collections.items():
+                    with ui.tab_panel(tab):
+                        collection_panel(tab, label)
+
+        with ui.tab_panel("About"):
+            ui.label("About Page")
+            ui.markdown("""
+                Source code available on [GitHub](https://github.com/dfloer/SC2k-cities)
+
+                Uses [OpenCity2k](https://github.com/OpenCity2k/OpenCity2k) to render city images, which doesn't completely support everything the game does, and doesn't render exactly the same.
+
+                Cities sourced from various spots, many are from [ClubOpolis](https://patcoston.com/co/download.aspx)
+            """)
+
 
-with ui.tab_panels(tabs, value="Random").classes('w-full') as tp:
-    with ui.tab_panel("Search"):
-        ui.label("Search Cities")
-        with ui.row():
-            with ui.column():
-                ui.label("Disaster")
-                disaster = ui.select(disaster_type)
-                ui.button(icon="search", on_click=lambda: city_search(all_cities, "disaster", disaster.value))
-            with ui.column():
-                ui.label("Weather")
-                weather = ui.select(weather_type)
-                ui.button(icon="search", on_click=lambda: city_search(all_cities, "weather", weather.value))
-
-    with ui.tab_panel("Random"):
-        rand = RandomView(all_cities)
-        rand.view()
-
-
-    with ui.tab_panel("Featured"):
-        ui.label("Featured Cities")
-
-    with ui.tab_panel("Ranking"):
-        ui.label("Ranked Cities")
-        all_cities_data = sess.query(DbCityData).all()
-        with ui.expansion("Highest Population"):
-            with ui.column():                
-                x = sorted(all_cities_data, key=lambda a: a.arco_pop + a.population, reverse=True)
-                i = 0
-                for c in x:
-                    ui.label(f"City: {c.name} has {c.arco_pop + c.population:,} sims.")
-                    i += 1
-                    if i == 10:
-                        break
-
-        with ui.expansion("Highest Funds"):
-            with ui.column():
-                x = sorted(all_cities_data, key=lambda a: a.funds, reverse=True)
-                i = 0
-                for c in x:
-                    if c.funds >= 0x7fffffff:
-                        continue
-                    ui.label(f"City: {c.name} has ${c.funds:,}.")
-                    i += 1
-                    if i == 10:
-                        break
-
-        with ui.expansion("Highest Crime"):
-            with ui.column():
-                x = sorted(all_cities_data, key=lambda a: a.crime, reverse=True)
-                i = 0
-                for c in x:
-                    ui.label(f"City: {c.name} has {c.crime:,}.")
-                    i += 1
-                    if i == 10:
-                        break
-
-        with ui.expansion("Highest Value"):
-            with ui.column():
-                x = sorted(all_cities_data, key=lambda a: a.value, reverse=True)
-                i = 0
-                for c in x:
-                    ui.label(f"City: {c.name} has {c.value:,}.")
-                    i += 1
-                    if i == 10:
-                        break
-
-    with ui.tab_panel("Collections"):
-        with ui.tabs() as coll_tabs:
-            ui.tab("Scenarios", icon="volcano")
-            ui.tab("Streets", icon="directions_car")
-            ui.tab("Copter", icon="flight")  # Why doesn't icon="helicopter" work?
-            ui.tab("Image", icon="photo")
-            ui.tab("Classic", icon="corporate_fare")
-            ui.tab("Other", icon="other_houses")
-
-        with ui.tab_panels(coll_tabs, value="Scenarios").classes("w-full"):
-
-            with ui.tab_panel("Scenarios"):
-                ui.label("Scenarios")
-
-            with ui.tab_panel("Streets"):
-                ui.label("Streets Cities")
-
-            with ui.tab_panel("Copter"):
-                ui.label("Copter Cities")
-
-            with ui.tab_panel("Image"):
-                ui.label("Cities That Make an Image")
-
-            with ui.tab_panel("Classic"):
-                ui.label("SimCity Classic Cities")
-
-            with ui.tab_panel("Other"):
-                ui.label("Other Cities")
-                
-    with ui.tab_panel("About"):
-        ui.label("About Page")
-        ui.markdown("""
-            Source code available on [GitHub](https://github.com/dfloer/SC2k-cities)
-                    
-            Uses [OpenCity2k](https://github.com/OpenCity2k/OpenCity2k) to render city images, which doesn't completely support everything the game does, and doesn't render exactly the same.
-            
-            Cities sourced from various spots, many are from [ClubOpolis](https://patcoston.com/co/download.aspx)
-        """)
-
-dark = ui.dark_mode()
-dark.enable()
 ui.run(port=8080, show=False)